@@ -6,33 +6,84 @@ import time
 import datetime
 # used for exiting program upon error
 import sys
-# library for interacing with csv files
-import csv
+# used for watching the stock csv file for changes
+import os
 # python logging library for monitoring and debugging
 import logging
-# interface class to IB market data
-from ibInterface import IbInterface
-from threading import Thread
-
-# for catching sigint
-import signal
+# queue-backed logging setup
+from botLogging import configure_logging
+# global conf file parsing
+import configparser
+# shared IB interface and data layer for running several strategies in one process
+from strategyEngine import Strategy, StrategyEngine
+# crash-safe record of the orders we own
+from orderJournal import OrderJournal
+# typed model of the stock csv file
+from stockUniverse import load_universe
+# exchange hours, holidays, and early closes
+from marketCalendar import MarketCalendar
+from threading import Thread, Lock, Event
+# work queue for the warm up threads
+import queue
+
+# thread dumps, in flight requests, and sampling profiler on SIGUSR1
+from diagnostics import Diagnostics, PROFILE_FILE, PROFILE_INTERVAL
+# local http endpoint streaming the state of the strategies
+from monitorServer import MonitorServer, MONITOR_HOST, MONITOR_PORT
 
 # CSV file for stock data and appropriate parameters
 STOCK_CSV = 'default.csv'
 # Conf file for global configuration parameters of the OptionSeller
 GLOBAL_CONF = 'global.conf'
-
-# Set logging level
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+# Journal file for the orders owned by the OptionSeller
+JOURNAL_FILE = 'orders.journal'
+# Strategy name used when the global conf file doesn't list any strategies.  Order references start with it
+STRATEGY_NAME = 'ibbot'
+# Client id for the IB connection, and number of connections to open.  Connections after the first use the following
+# client ids and carry market data and contract details only.  Raise this for large watchlists
+IB_CLIENT_ID = 0
+IB_NUM_CLIENTS = 1
+
+# Only options expiring within this many days are traded, so only that part of each chain is requested
+OPTION_MAX_DAYS = 31
+# Fraction around the stock price to keep strikes for when loading chains, e.g. .3 for 30% either way.  None keeps
+# every strike, which is safest for calls sold against a position that is far under water
+CHAIN_STRIKE_BAND = None
+
+# Seconds between passes of the trade loop, and between passes near the close on expiration days
+LOOP_INTERVAL = 10
+EXPIRY_LOOP_INTERVAL = 3
+# How close to the close of an expiration day the tighter cadence starts, in seconds
+EXPIRY_CLOSE_WINDOW = 30*60
+# How long before the open chains and quote streams are warmed up, in seconds
+PREWARM_TIME = 15*60
+
+# Fraction of NetLiquidation that cash-secured puts, held and working, may tie up
+MAX_COLLATERAL = 1.0
+
+# Tickers per chain request batch during the warm up, and number of threads loading batches at once.  Smaller batches
+# let the trade loop start on the first tickers sooner
+WARM_BATCH = 10
+WARM_WORKERS = 4
+# Seconds to wait before warming up again after a step of the warm up failed
+WARM_RETRY_DELAY = 30
+
+# Log level used when the global conf file doesn't set one
+LOG_LEVEL = 'INFO'
 
 # Class for selling put and call options on desired stocks at desired target prices
-class OptionSeller:
-	def __init__(self):
-		# Parse global parameters
-
-		# extract data from stock csv file into a list of dicts for easy use
-		self.stock_csv = STOCK_CSV
-		self.stock_list_of_dicts = []
+# Runs as a strategy plugin on the shared data layer.  data is the strategy's data client, used in place of an IbInterface
+class OptionSeller(Strategy):
+	chain_max_days = OPTION_MAX_DAYS
+	chain_strike_band = CHAIN_STRIKE_BAND
+
+	def __init__(self, data, name=STRATEGY_NAME, stock_csv=STOCK_CSV, journal_file=JOURNAL_FILE):
+		Strategy.__init__(self, data, name)
+
+		# extract data from stock csv file into a stock universe for easy use
+		self.stock_csv = stock_csv
+		self.universe = None
+		self.stock_csv_stamp = None
 		self.parse_stocks()
 
 		# Buy and sell thresholds for options selling
@@ -43,183 +94,519 @@ class OptionSeller:
 		self.loop_max = 2
 		self.mod_max = 2
 
-		# Interface to IB api
-		self.ibif = IbInterface()
+		# Interface to IB api, shared with any other strategies through the data client
+		self.ibif = data
 
 		logging.debug('Imported the following stock data: ')
-		for row in self.stock_list_of_dicts:
-			logging.debug(row)
-
-		self.quote_list = []
+		for stock in self.universe:
+			logging.debug(stock)
+
+		# Exchange calendar.  The trade loop idles outside trading hours, and warms up quote streams and chains shortly
+		# before the open.  session_ready is set once the warm up is done, and wake_time is when the idle loop wakes next
+		self.calendar = MarketCalendar()
+		self.session_ready = False
+		self.wake_time = None
+
+		# Warm up progress.  Tickers go in warm_tickers once their chain and first quote are loaded, and the trade loop
+		# only acts on those.  account_ready is set once positions and open orders are loaded
+		self.warm_lock = Lock()
+		self.warm_tickers = set()
+		self.chained_tickers = set()
+		self.quoted_tickers = set()
+		self.account_ready = Event()
+		self.warm_start = None
+		# time before which a failed warm up is not started again
+		self.warm_retry_time = 0
+
+		# Trade loop timing, published for the monitor with the rest of the state after every pass
+		self.loop_cnt = 0
+		self.loop_start = None
+		self.loop_duration = None
+
+		# latest quotes keyed by ticker, and positions indexed by ticker for constant time lookups in the loop
+		self.quote_dict = {}
 		self.position_list = []
+		self.stock_holdings = {}
+		self.option_holdings = {}
 		self.call_order_list = []
 		self.put_order_list = []
+		# new orders, modifications of working orders, and cancels are queued up and sent to the ib interface as batches
+		self.pending_orders = []
+		self.pending_mods = []
+		self.pending_cancels = []
+
+		# Collateral and exposure totals, kept up to date from positions and working orders.  Shared by all strategies
+		self.exposure = data.exposure
+
+		# Journal of owned orders.  Replay it and pick up any orders still working from before a crash or restart
+		self.journal = OrderJournal(journal_file, ref_prefix=name)
+		self.recover_orders()
+
 		self.trade_thread = Thread(target=self.trade_loop)
 		self.trade = True
 		self.trade_thread.start()
 
 	# extract data from the stock csv file
 	def parse_stocks(self):
-		# declare array to store data from csv
-		logging.debug("Parsing stock csv")
-		data_array = []
-		with open(self.stock_csv, 'r') as csvfile:
-			stock_reader = csv.reader(csvfile)
-			for row in stock_reader:
-				logging.debug(str(row))
-				data_array.append(row)
-
-		# the first row will be keys, and the next rows will be actual stock data
-		# zip the data into a convenient list of dicts
-		keys = data_array[0]
-		logging.debug("zipping stock data")
-		for i in range (1, len(data_array)):
-			stock_dict = dict(zip(keys, data_array[i]))
-			stock_dict['targetBuy'] = float(stock_dict['targetBuy'])
-			stock_dict['targetSell'] = float(stock_dict['targetSell'])
-			stock_dict['weightTarget'] = float(stock_dict['weightTarget'])
-			self.stock_list_of_dicts.append(stock_dict)
-
-
-	# Get quotes of the stocks of interest from the ib interface
-	def get_quotes(self):
+		self.stock_csv_stamp = self.get_stock_csv_stamp()
+		self.universe = load_universe(self.stock_csv)
+
+	# Modification time and size of the stock csv file, used to notice edits.  None if the file can't be read
+	def get_stock_csv_stamp(self):
+		try:
+			stat = os.stat(self.stock_csv)
+		except OSError:
+			return None
+		return (stat.st_mtime_ns, stat.st_size)
+
+	# Check the stock csv file for changes, and apply them to the running universe without a restart
+	# Only changed rows are parsed.  Removed tickers stop streaming quotes, added tickers start streaming and get their
+	# chains warmed, and changed targets are updated in place.  Orders already working are left alone
+	def reload_stocks(self):
+		stamp = self.get_stock_csv_stamp()
+		if stamp is None or stamp == self.stock_csv_stamp:
+			return
+		self.stock_csv_stamp = stamp
+		try:
+			new_universe = load_universe(self.stock_csv, self.universe)
+		except (ValueError, IOError) as e:
+			# Most likely caught mid-edit.  Keep the current universe, and try again on the next change
+			logging.error('Not reloading stock csv: %s', str(e))
+			return
+		added, removed, changed = self.universe.apply(new_universe)
+		if not added and not removed and not changed:
+			return
+		logging.info('Reloaded stock csv. Added: %s Removed: %s Changed: %s', str([stock.ticker for stock in added]), str(removed), str([stock.ticker for stock in changed]))
+		self.ibif.unsubscribe_stock_quotes(removed)
+		if added:
+			self.ibif.subscribe_stock_quotes([stock.ticker for stock in added])
+			self.ibif.load_chains([stock.ticker for stock in added])
+			with self.warm_lock:
+				self.warm_tickers = self.warm_tickers | set(stock.ticker for stock in added)
+
+	# Get quotes of the stocks of interest from the ib interface, the tickers in warm
+	# All quotes are requested as one batch, spread across the interface's connection pool
+	def get_quotes(self, warm):
 		logging.debug("Getting quotes...")
-		self.quote_list = []
-		for stock in self.stock_list_of_dicts:
-			quote_data = self.ibif.get_stock_quote(stock['ticker'])
+		self.quote_dict = self.ibif.get_stock_quotes([ticker for ticker in self.universe.tickers() if ticker in warm])
+		for ticker, quote_data in self.quote_dict.items():
 			if quote_data['last'] is None:
 				price = quote_data['close']
 			else:
 				price = quote_data['last']
-			logging.debug('Last price of %s: %f', stock['ticker'], price)
-			quote_data['ticker'] = stock['ticker']
-			self.quote_list.append(quote_data)
+			logging.debug('Last price of %s: %s, field ages %s', ticker, price, self.ibif.get_quote_ages(ticker), extra={'ticker': ticker})
+			quote_data['ticker'] = ticker
 
 	# Get current positions from the ib interface
 	def get_positions(self):
 		self.position_list = self.ibif.get_positions()
-		logging.debug("Current holdings: " + str(self.position_list))
+		logging.debug('Current holdings: %s', self.position_list)
+		self.stock_holdings = {}
+		self.option_holdings = {}
+		for position in self.position_list:
+			if position['type'] == 'STK':
+				self.stock_holdings[position['ticker']] = position
+			elif position['type'] == 'OPT':
+				self.option_holdings.setdefault(position['ticker'], []).append(position)
+		self.exposure.update_positions(self.position_list)
+
+	# Get NetLiquidation for the collateral checks
+	def get_account_value(self):
+		self.exposure.set_net_liquidation(self.ibif.get_account_value())
+		logging.debug('Exposure: %s', self.exposure.summary())
 
 	# Update current orders, modifying or cancelling ones that require it
 	def update_orders(self):
 		# First, remove any orders that are no longer open
 		open_list = self.ibif.get_open_order_ids()
-		logging.debug('Open order ids: ' + str(open_list))
+		logging.debug('Open order ids: %s', open_list)
+		for order in self.put_order_list + self.call_order_list:
+			if order['id'] not in open_list:
+				self.journal.remove_order(order['order_ref'])
+				self.exposure.remove_order(order)
 		self.put_order_list = [order for order in self.put_order_list if order['id'] in open_list]
 		self.call_order_list = [order for order in self.call_order_list if order['id'] in open_list]
-		logging.debug('Current put orders ' + str(self.put_order_list))
-		logging.debug('Current call orders ' + str(self.call_order_list))
+		logging.debug('Current put orders %s', self.put_order_list)
+		logging.debug('Current call orders %s', self.call_order_list)
 
 		# Then, iterate through open orders and leave, modify, or cancel them
+		# Statuses are pushed by TWS/Gateway, refreshed by the open order request above, and fills are counted in the
+		# interface's fill ledger from execution reports, so no order needs a request of its own
+		statuses = self.ibif.get_order_statuses()
 		for order in self.put_order_list + self.call_order_list:
-			status, filledQuant = self.ibif.get_order_status(order['id'])
-			if status is not None:
-				logging.debug('Order status is ' + str(status))
+			entry = statuses.get(order['id'])
+			if entry is not None:
+				status = entry['status']
+				logging.debug('Order status is %s', status, extra={'ticker': order['ticker'], 'order_id': order['id']})
 			else:
 				logging.debug('Order did not return a status.  Must be closed already.')
-				return
+				continue
+			filledQuant = max(entry['filled'], self.ibif.get_filled_quantity(order['id']))
 			if filledQuant > 0 and filledQuant < order['quantity']:
-				self.handle_partial_fill(order)
-				if order['right'] == 'P':
-					self.put_order_list = [o for o in self.put_order_list if o['id'] != order['id']]
-				else:
-					self.call_order_list = [o for o in self.call_order_list if o['id'] != order['id']]
+				# Partially filled orders are cancelled and re-sent with the remaining quantity
+				self.pending_cancels.append((order, True))
 			elif status == 'submitted' or status == 'Submitted':
 				self.modify_option_sell_order(order)
 			# This will only happen if order has been filled between now and the ibif order check
 			elif status == 'filled' or status == 'Filled':
-				self.put_order_list = [o for o in self.put_order_list if o['id'] != order['id']]
+				self.remove_order(order)
 			# If order status isn't submitted or filled then we should do nothing at this point
 			else:
 				logging.debug('Order not yet submitted. Doing nothing...')
 
+		# Send all of the cancels, then all of the modifications and re-sent orders, as batches
+		self.cancel_queued_orders()
+		self.submit_orders()
+
+	# Reconcile the journal against the orders that are actually working, and adopt the ones that are still open
+	# Orders are matched on id first, and then on order reference for orders whose placement never got journaled
+	def recover_orders(self):
+		journal_orders = self.journal.load()
+		if not journal_orders:
+			return
+		logging.info('Recovering %d orders from the journal', len(journal_orders))
+		open_orders = self.ibif.get_open_orders()
+		self.get_positions()
+		ref_ids = dict((o['order_ref'], oid) for oid, o in open_orders.items() if o.get('order_ref'))
+		for ref, order in journal_orders.items():
+			order_id = order.get('id')
+			if order_id not in open_orders:
+				order_id = ref_ids.get(ref)
+			if order_id is None:
+				# Filled orders show up in the positions, and anything else is dead.  Either way we no longer own a working order
+				logging.info('Journaled order %s on %s is no longer working. Holding: %s', ref, order['ticker'], str(self.get_stock_holding(order['ticker'])))
+				self.journal.remove_order(ref)
+				continue
+			order['id'] = order_id
+			order.setdefault('loop_cnt', 0)
+			order.setdefault('mod_cnt', 0)
+			# The working order is the source of truth for price and quantity
+			order['price'] = open_orders[order_id]['price']
+			order['quantity'] = open_orders[order_id]['quantity']
+			self.journal.write_order(order)
+			self.exposure.add_order(order)
+			if order['right'] == 'C':
+				self.call_order_list.append(order)
+			else:
+				self.put_order_list.append(order)
+			logging.info('Recovered order %d on %s', order_id, order['ticker'], extra={'ticker': order['ticker'], 'order_id': order_id})
+
+	# Remove an order from the put or call order list
+	def remove_order(self, order):
+		if order['right'] == 'P':
+			self.put_order_list = [o for o in self.put_order_list if o['id'] != order['id']]
+		else:
+			self.call_order_list = [o for o in self.call_order_list if o['id'] != order['id']]
+		self.journal.remove_order(order['order_ref'])
+		self.exposure.remove_order(order)
+
+	# Queue a new order for batch submission.  target must be keyed like the ibif place_option_order arguments
+	# Each order gets a fresh reference, so it can be recognized in the open order list after a restart
+	# Queued orders count towards exposure right away, so later checks in the same pass see them
+	# Put sales given a weight_target are only queued if they fit the collateral limit and the weight target.
+	# Returns False if the order wasn't queued
+	def queue_order(self, target, weight_target=None):
+		target['order_ref'] = self.journal.new_ref()
+		if target['action'] == 'SELL' and target['right'] == 'P' and weight_target is not None:
+			if not self.exposure.check_put(target['ticker'], target['strike'], target['quantity'], weight_target, target):
+				return False
+		else:
+			self.exposure.add_order(target)
+		self.pending_orders.append(target)
+		return True
+
+	# Submit queued modifications and new orders to the ib interface as a single batch
+	# New orders are added to the order lists with bookkeeping attributes for order monitoring
+	def submit_orders(self):
+		if not self.pending_mods and not self.pending_orders:
+			return
+		# journal the intent before anything is sent, so a crash mid-batch can't orphan an order
+		for target in self.pending_orders:
+			self.journal.write_order(target)
+		id_list = self.ibif.place_orders(self.pending_mods + self.pending_orders)
+		for target, order_id in zip(self.pending_orders, id_list[len(self.pending_mods):]):
+			if order_id is None:
+				logging.error('Order on %s was rejected by the interface.', target['ticker'], extra={'ticker': target['ticker'], 'order_ref': target['order_ref']})
+				self.journal.remove_order(target['order_ref'])
+				self.exposure.remove_order(target)
+				continue
+			target['id'] = order_id
+			target['loop_cnt'] = 0
+			target['mod_cnt'] = 0
+			self.journal.write_order(target)
+			if target['right'] == 'C':
+				self.call_order_list.append(target)
+			else:
+				self.put_order_list.append(target)
+		self.pending_mods = []
+		self.pending_orders = []
+
+	# Cancel all queued orders as a single batch, and hand partially filled ones off to be re-sent
+	def cancel_queued_orders(self):
+		if not self.pending_cancels:
+			return
+		results = self.ibif.cancel_orders([order['id'] for order, resend in self.pending_cancels])
+		for order, resend in self.pending_cancels:
+			self.remove_order(order)
+			if resend:
+				cancelled_flag, filled = results[order['id']]
+				self.handle_partial_fill(order, cancelled_flag, filled)
+		self.pending_cancels = []
+
 	# Return the stock holdings for the given ticker
 	def get_stock_holding(self, ticker):
-		for position in self.position_list:
-			if position['ticker'] == ticker and position['type'] == 'STK':
-				return position
-		return None
+		return self.stock_holdings.get(ticker)
 
 	# Return a list of option holdings for the current ticker
 	def get_option_holdings(self, ticker):
-		ret_list = [position for position in self.position_list if position['ticker'] == ticker and position['type'] == 'OPT']
-		if ret_list:
-			return ret_list
-		else:
-			return None
+		return self.option_holdings.get(ticker)
 
-	# Extract a quote from the current quote list
+	# Extract a quote from the current quotes
 	def get_current_quote(self, ticker):
-		for quote in self.quote_list:
-			if quote['ticker'] == ticker:
-				return quote
+		return self.quote_dict.get(ticker)
 
 	# Looping method to execute the trading strategy
 	def trade_loop(self):
 		logging.debug("In trade loop...")
 		while self.trade:
-			# Get data from the ib interface
-			self.get_quotes()
+			# Nothing can trade outside the session, so don't spend requests on it
+			if not self.calendar.is_open():
+				self.idle()
+				continue
+			# The interface reconnects on its own.  Don't make decisions on cached data in the meantime
+			if not self.ibif.connected:
+				logging.warning('Not connected to TWS/Gateway.  Waiting for reconnect...')
+				time.sleep(1)
+				continue
+			# Started or reconnected mid-session without a warm up, or the last warm up failed
+			if not self.session_ready and time.time() >= self.warm_retry_time:
+				self.prewarm()
+			# Positions and open orders are needed for every decision, so wait for them before the first pass
+			if not self.account_ready.is_set():
+				time.sleep(.1)
+				continue
+			# A failing pass is logged and the loop carries on, rather than the trade thread dying silently
+			try:
+				self.trade_pass()
+			except Exception:
+				logging.exception('Trade loop pass failed.  Trying again next pass.')
+			self.sleep_while_trading(self.loop_interval())
+
+	# One pass of the trade loop over the universe
+	def trade_pass(self):
+		self.loop_start = time.time()
+		# Pick up any edits to the stock csv file
+		self.reload_stocks()
+		# The warm up threads keep adding tickers during the pass.  Work from the warm tickers as of now, so every
+		# ticker acted on also had its quote fetched this pass.  The set is replaced, never changed, so this is a copy
+		warm = self.warm_tickers
+		# Get data from the ib interface
+		self.get_quotes(warm)
+		self.get_positions()
+		self.get_account_value()
+		# Update current orders
+		self.update_orders()
+		order_tickers = set(order['ticker'] for order in self.put_order_list + self.call_order_list)
+		for stock in self.universe:
+			ticker = stock.ticker
+			# Skip tickers that are still warming up.  They are picked up on a later pass
+			if ticker not in warm:
+				logging.debug('%s is not warmed up yet', ticker, extra={'ticker': ticker})
+				continue
+			logging.debug('Executing strategy for %s', ticker, extra={'ticker': ticker})
+			# If we have open orders for this ticker, we should do nothing
+			if ticker in order_tickers:
+				logging.info('Order is open for %s. Moving on...', ticker)
+				continue
+
+			# At this point, no open orders. gather all the data we need to make a decision, and pass it to the decision making method
+			logging.debug('No open orders for %s', ticker, extra={'ticker': ticker})
+			# Retrieve position once more to ensure an order was not filled between our last update and now
 			self.get_positions()
-			# Update current orders
-			self.update_orders()
-			for stock in self.stock_list_of_dicts:
-				ticker = stock['ticker']
-				logging.debug("Executing strategy for " + ticker)
-				# If we have open orders for this ticker, we should do nothing
-				existing_order = False
-				for order in self.put_order_list + self.call_order_list:
-					if order['ticker'] == stock['ticker']:
-						existing_order = True
-						break
-				if existing_order:
-					logging.info('Order is open for %s. Moving on...', ticker)
-					continue
-
-				# At this point, no open orders. gather all the data we need to make a decision, and pass it to the decision making method
-				logging.debug('No open orders for ' + ticker)
-				# Retrieve position once more to ensure an order was not filled between our last update and now
-				self.get_positions()
-				stk_hold = self.get_stock_holding(ticker)
-				opt_hold = self.get_option_holdings(ticker)
-				quote = self.get_current_quote(ticker)
-				self.trade_decision(stock, stk_hold, opt_hold, quote)
-			time.sleep(10)
+			stk_hold = self.get_stock_holding(ticker)
+			opt_hold = self.get_option_holdings(ticker)
+			quote = self.get_current_quote(ticker)
+			self.trade_decision(stock, stk_hold, opt_hold, quote)
+		# Send every order decided on during this pass as one batch
+		self.submit_orders()
+		self.loop_cnt = self.loop_cnt + 1
+		self.loop_duration = time.time() - self.loop_start
+		self.publish_state(self.monitor_sections())
+
+	# State for the monitor, built from what the loop already has in memory.  Everything is copied, so the published
+	# state doesn't change under the monitor when the next pass runs
+	def monitor_sections(self):
+		positions = {}
+		for pos in self.position_list:
+			key = ' '.join(str(pos.get(field, '')) for field in ('ticker', 'type', 'expiry', 'right', 'strike')).strip()
+			positions[key] = dict(pos)
+		orders = {}
+		for order in self.put_order_list + self.call_order_list:
+			orders[order['order_ref']] = dict((field, order.get(field)) for field in
+											('id', 'ticker', 'action', 'right', 'expiry', 'strike', 'price', 'quantity', 'loop_cnt', 'mod_cnt'))
+		return {
+				'universe': dict((stock.ticker, stock.to_dict()) for stock in self.universe),
+				'quotes': dict((ticker, dict(quote)) for ticker, quote in self.quote_dict.items()),
+				'positions': positions,
+				'orders': orders,
+				'exposure': self.exposure.summary(),
+				'loop': {'count': self.loop_cnt, 'start': self.loop_start, 'duration': self.loop_duration,
+						'interval': self.loop_interval(), 'warm_tickers': len(self.warm_tickers)}
+		}
+
+	# Wait out the time outside the session.  Quote streams are dropped after the close, and picked up again with the
+	# chains shortly before the next open
+	def idle(self):
+		now = self.calendar.now()
+		session_open = self.calendar.next_session(now)[0]
+		prewarm_at = session_open - datetime.timedelta(seconds=PREWARM_TIME)
+		if now < prewarm_at:
+			if self.session_ready:
+				self.end_session()
+			wake = prewarm_at
+		elif not self.session_ready:
+			if not self.ibif.connected:
+				logging.warning('Not connected to TWS/Gateway.  Waiting for reconnect before warming up...')
+				time.sleep(1)
+				return
+			# a failed warm up is retried after a delay
+			if time.time() < self.warm_retry_time:
+				time.sleep(1)
+				return
+			self.prewarm()
+			wake = session_open
+		else:
+			wake = session_open
+		if wake != self.wake_time:
+			self.wake_time = wake
+			logging.info('Market closed.  Sleeping until %s', wake.strftime('%Y-%m-%d %H:%M %Z'))
+		self.sleep_while_trading((wake - self.calendar.now()).total_seconds())
+
+	# Get ready for the session: pick up csv edits, start the quote streams, and warm up chains, quotes, positions, and
+	# open orders in the background
+	def prewarm(self):
+		logging.info('Warming up for the session')
+		self.reload_stocks()
+		# Stream quotes for the universe, as far as market data lines allow
+		self.ibif.subscribe_stock_quotes(self.universe.tickers())
+		# set first, so a warm up step failing right away can still clear it
+		self.session_ready = True
+		self.start_warm_up()
+
+	# Stop the quote streams after the close
+	def end_session(self):
+		logging.info('Session over.  Stopping quote streams')
+		self.ibif.unsubscribe_stock_quotes(self.universe.tickers())
+		self.session_ready = False
+		with self.warm_lock:
+			self.warm_tickers = set()
+
+	# Load chains, quotes, positions, and open orders for the whole universe at once, on background threads
+	# Chains are loaded in batches by several threads, quotes as one batch, and positions and open orders on their own.
+	# All requests go through the interface's pacing, so the warm up stays within the API limits
+	def start_warm_up(self):
+		tickers = self.universe.tickers()
+		with self.warm_lock:
+			self.warm_tickers = set()
+			self.chained_tickers = set()
+			self.quoted_tickers = set()
+		self.account_ready.clear()
+		self.warm_start = time.time()
+		batch_queue = queue.Queue()
+		for start in range(0, len(tickers), WARM_BATCH):
+			batch_queue.put(tickers[start:start + WARM_BATCH])
+		threads = [Thread(target=self.run_warm_step, args=(self.warm_account,)),
+				Thread(target=self.run_warm_step, args=(self.warm_quotes, tickers))]
+		threads = threads + [Thread(target=self.run_warm_step, args=(self.warm_chains, batch_queue)) for i in range(WARM_WORKERS)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+	# Run one step of the warm up on its thread.  If it fails, the failure is logged and the whole warm up is started
+	# again after WARM_RETRY_DELAY, instead of leaving tickers or the account never ready
+	def run_warm_step(self, step, *args):
+		try:
+			step(*args)
+		except Exception:
+			logging.exception('Warm up step %s failed.  Warming up again in %d seconds.', step.__name__, WARM_RETRY_DELAY)
+			self.warm_retry_time = time.time() + WARM_RETRY_DELAY
+			self.session_ready = False
+
+	# Warm up thread for positions and open orders
+	def warm_account(self):
+		self.get_positions()
+		self.get_account_value()
+		self.ibif.get_open_orders()
+		self.account_ready.set()
+		logging.info('Positions and open orders loaded in %.1f seconds', time.time() - self.warm_start)
+
+	# Warm up thread for the first quotes of the universe
+	def warm_quotes(self, tickers):
+		self.ibif.get_stock_quotes(tickers)
+		self.mark_warm(tickers, self.quoted_tickers)
+
+	# Warm up thread for chains.  Takes batches of tickers off the queue until it is empty
+	def warm_chains(self, batch_queue):
+		while self.trade:
+			try:
+				batch = batch_queue.get_nowait()
+			except queue.Empty:
+				return
+			self.ibif.load_chains(batch)
+			self.mark_warm(batch, self.chained_tickers)
+
+	# Record that part of the warm up is done for the given tickers.  Tickers with both their chain and quote loaded
+	# are ready for the trade loop
+	def mark_warm(self, tickers, done_set):
+		with self.warm_lock:
+			done_set.update(tickers)
+			ready = set(ticker for ticker in tickers if ticker in self.chained_tickers and ticker in self.quoted_tickers)
+			self.warm_tickers = self.warm_tickers | ready
+			warm_cnt = len(self.warm_tickers)
+		if ready:
+			logging.debug('Warmed up %s', str(sorted(ready)))
+		if ready and warm_cnt == len(self.universe):
+			logging.info('Warm up done for %d tickers in %.1f seconds', warm_cnt, time.time() - self.warm_start)
+
+	# Seconds until the next pass of the trade loop.  Near the close on expiration days, passes come quicker
+	def loop_interval(self):
+		now = self.calendar.now()
+		close = self.calendar.session_close(now)
+		if close is not None and self.calendar.is_expiration_day(now.date()) and (close - now).total_seconds() <= EXPIRY_CLOSE_WINDOW:
+			return EXPIRY_LOOP_INTERVAL
+		return LOOP_INTERVAL
+
+	# Sleep for the given number of seconds, waking up early if trading is stopped
+	def sleep_while_trading(self, seconds):
+		end = time.time() + seconds
+		while self.trade and time.time() < end:
+			time.sleep(max(0, min(1, end - time.time())))
 
 	# Make a decision on what to do with the given ticker
 	def trade_decision(self, stock, stk_hold, opt_hold, quote):
-		ticker = stock['ticker']
+		ticker = stock.ticker
 		if quote['last'] is None:
 			price = quote['close']
 		else:
 			price = quote['last']
 		# Determine how far away we are from targets
-		buy_diff = (price - stock['targetBuy'])/stock['targetBuy']
-		sell_diff = (stock['targetSell'] - price)/stock['targetSell']
-
-		# Determine current call and put holdings
-		call_hold = None
-		put_hold = None
-		put_exposure = 0
-		call_exposure = 0
-		if opt_hold:
-			put_hold = [p for p in opt_hold if p['right'] == 'P']
-			call_hold = [c for c in opt_hold if c['right'] == 'C']
-		if put_hold:
-			put_exposure = sum([p['quantity'] for p in put_hold])
-		if call_hold:
-			call_exposure = sum([c['quantity'] for c in call_hold])
+		buy_diff = (price - stock.target_buy)/stock.target_buy
+		sell_diff = (stock.target_sell - price)/stock.target_sell
+
+		# Determine current call and put holdings from the running totals
+		put_exposure = self.exposure.put_position(ticker)
+		call_exposure = self.exposure.call_position(ticker)
 
 		logging.debug('Current put exposure on %s: %d', ticker, put_exposure)
 		logging.debug('Current call exposure on %s: %d', ticker, call_exposure)
 
 		# Determine target quantity for positions.  Average into and out of positions based on the target weight
-		if stock['weightTarget'] <= 300:
+		if stock.weight_target <= 300:
 			# If target is 100 or 200, just do 1 contract (100 shares) at a time
 			target_quantity = 1
 		else:
 			# Otherwise, handle the position in thirds, rounding up
-			target_quantity = round(stock['weightTarget']/300.0 + .5)
+			target_quantity = round(stock.weight_target/300.0 + .5)
 
 		# if stk_hold is None and opt_hold is None:
 		if stk_hold is None:
@@ -236,17 +623,13 @@ class OptionSeller:
 		# If we currently hold the stock
 		else:
 			# If current holdings between 0 and target holdings, sell more puts and sell matching strangle calls
-			if stk_hold['quantity'] < stock['weightTarget']:
-				if not call_hold:
+			if stk_hold['quantity'] < stock.weight_target:
+				if not self.exposure.holds_calls(ticker):
 					# Sell calls on all held shares.  Might change this to match the put quantity later, not set on it.
 					self.sell_strangle_calls(stock, price, stk_hold['quantity']/100, stk_hold)
-				if not put_hold:
+				if not self.exposure.holds_puts(ticker):
 					# Put quantity will either be the target quantity calculated earlier or the amount left until weight target hit, whichever is smaller
-					# TEST
-					exp1 = datetime.date(2017, 11, 24)
-					q = self.ibif.get_option_quote('NUE', exp1, 'P', 55.5)
-					print('After sell_strangle_calls exit', q)
-					put_quantity = min((stock['weightTarget'] - stk_hold['quantity'])/100, target_quantity)
+					put_quantity = min((stock.weight_target - stk_hold['quantity'])/100, target_quantity)
 					self.sell_puts(stock, price, put_quantity)
 				return
 
@@ -256,14 +639,14 @@ class OptionSeller:
 				call_quantity = min(stk_hold['quantity']/100, target_quantity)
 				self.sell_exit_calls(stock, price, call_quantity, stk_hold)
 				return
-		logging.info('Nothing to do for ' + ticker)
+		logging.info('Nothing to do for %s', ticker, extra={'ticker': ticker})
 
 	# We run into an odd edge case when an order has partially filled.
 	# I don't know what happens to a partially filled order when we attempt to modify it, and unfortunately
 	# this is a very difficult situation for which to develop a test case.
 	# So it seems best to cancel and re-send with new desired quantity, since we know exactly what will happen that way
-	def handle_partial_fill(self, order):
-		cancelled_flag, filled = self.ibif.cancel_order(order['id'])
+	# Called with the result of the batch cancel, and queues the remaining quantity as a new order
+	def handle_partial_fill(self, order, cancelled_flag, filled):
 		# check if the order was cancelled property, and get the final amount of contracts filled
 		if cancelled_flag:
 			new_quant = order['quantity'] - filled
@@ -282,13 +665,7 @@ class OptionSeller:
 		del send_order['loop_cnt']
 		del send_order['mod_cnt']
 		del send_order['id']
-		order['id'] = self.ibif.place_option_order(**send_order)
-		order['loop_cnt'] = 0
-		order['mod_cnt'] = 0
-		if order['right'] == 'C':
-			self.call_order_list.append(order)
-		else:
-			self.put_order_list.append(order)
+		self.queue_order(send_order)
 
 	# Reduce asking price if appropriate.  Otherwise just increment loop cnt for the order, or cancel it
 	def modify_option_sell_order(self, order_dict):
@@ -298,6 +675,7 @@ class OptionSeller:
 		if loop_cnt < self.loop_max:
 			logging.debug('Order with id %d should not be modified yet', order_dict['id'])
 			order_dict['loop_cnt'] = loop_cnt + 1
+			self.journal.write_order(order_dict)
 		# If it should be modified and hasn't hit the max modifications yet
 		# To modify an order with the IB api, just resubmit with the same order id
 		elif mod_cnt < self.mod_max:
@@ -310,17 +688,14 @@ class OptionSeller:
 			del send_order['loop_cnt']
 			del send_order['mod_cnt']
 			del send_order['id']
-			self.ibif.place_option_order(**send_order)
+			self.pending_mods.append(send_order)
 			order_dict['loop_cnt'] = 0
 			order_dict['mod_cnt'] = mod_cnt + 1
+			self.journal.write_order(order_dict)
 		# If it has hit max mods, should be cancelled
 		else:
 			logging.debug('Order with id %d has been modified too many times.  Cancelling...', order_dict['id'])
-			self.ibif.cancel_order(order_dict['id'])
-			if order_dict['right'] == 'P':
-				self.put_order_list = [o for o in self.put_order_list if o['id'] != order_dict['id']]
-			else:
-				self.call_order_list = [o for o in self.call_order_list if o['id'] != order_dict['id']]
+			self.pending_cancels.append((order_dict, False))
 			return True
 
 		# If we get here, we need to modify the order list and return that the order has not been cancelled
@@ -336,80 +711,57 @@ class OptionSeller:
 			
 	# Sell puts for the given ticker
 	def sell_puts(self, stock, stk_price, quantity):
-		logging.info('Selling puts on ' + stock['ticker'])
-		ticker = stock['ticker']
+		logging.info('Selling puts on %s', stock.ticker, extra={'ticker': stock.ticker})
+		ticker = stock.ticker
 		# Find the best option strike and expiry
 		target = self.search_for_option(ticker, stk_price, 'put', stock)
 		# If we found a target, submit an order
 		if target is not None:
-			logging.info('Selling put on %s with strike %f and expiry %s for price %f', ticker, target['strike'], str(target['expiry']), target['price'])
 			# append target dict for easy sending to ibif
 			target['ticker'] = ticker
 			target['quantity'] = int(quantity)
 			target['right'] = 'P'
 			target['action'] = 'SELL'
-			order_id = self.ibif.place_option_order(**target)
-			# append with bookkeeping attributes for order monitoring
-			target['id'] = order_id
-			target['loop_cnt'] = 0
-			target['mod_cnt'] = 0
-			self.put_order_list.append(target)
+			# queue for the batch sent at the end of this pass over the universe, if it fits the collateral limit and
+			# the weight target
+			if self.queue_order(target, stock.weight_target):
+				logging.info('Selling put on %s with strike %f and expiry %s for price %f', ticker, target['strike'], target['expiry'], target['price'], extra={'ticker': ticker})
 		else:
 			logging.warning('No suitable put found to sell for %s', ticker)
 
 	# Sell calls as part of a strangle. Called when we hold the stock but don't hold the target weight yet
 	def sell_strangle_calls(self, stock, stk_price, quantity, stk_hold):
-		ticker = stock['ticker']
-		logging.info('Selling calls on ' + ticker + 'as part of a strangle')
-		# TEST
-		exp1 = datetime.date(2017, 11, 24)
-		q = self.ibif.get_option_quote('NUE', exp1, 'P', 55.5)
-		print('Before search for option', q)
+		ticker = stock.ticker
+		logging.info('Selling calls on %s as part of a strangle', ticker, extra={'ticker': ticker})
 		# Get available options expiries and sort them
 		target = self.search_for_option(ticker, stk_price, 'strangle_call', stock, stk_hold)
-		# TEST
-		exp1 = datetime.date(2017, 11, 24)
-		q = self.ibif.get_option_quote('NUE', exp1, 'P', 55.5)
-		print('After search for option', q)
 		# If we found a target, submit an order
 		if target is not None:
-			logging.info('Selling call on %s with strike %f and expiry %s for price %f', ticker, target['strike'], str(target['expiry']), target['price'])
+			logging.info('Selling call on %s with strike %f and expiry %s for price %f', ticker, target['strike'], target['expiry'], target['price'], extra={'ticker': ticker})
 			# append target dict for easy sending to ibif
 			target['ticker'] = ticker
 			target['quantity'] = int(quantity)
 			target['right'] = 'C'
 			target['action'] = 'SELL'
-			order_id = self.ibif.place_option_order(**target)
-			# append with bookkeeping attributes for order monitoring
-			target['id'] = order_id
-			target['loop_cnt'] = 0
-			target['mod_cnt'] = 0
-			self.call_order_list.append(target)
-			# TEST
-			exp1 = datetime.date(2017, 11, 24)
-			q = self.ibif.get_option_quote('NUE', exp1, 'P', 55.5)
-			print('At the end of sell strangle calls', q)
+			# queue for the batch sent at the end of this pass over the universe
+			self.queue_order(target)
 		else:
 			logging.warning('No suitable strangle call found to sell for %s', ticker)
 
 	# Sell calls to begin exiting a stock position. Will be called when target weight is equal to target quantity, and we are near sell target
 	def sell_exit_calls(self, stock, stk_price, quantity, stk_hold):
-		ticker = stock['ticker']
-		logging.info('Selling calls on ' + ticker + ' to exit the position')
+		ticker = stock.ticker
+		logging.info('Selling calls on %s to exit the position', ticker, extra={'ticker': ticker})
 		target = self.search_for_option(ticker, stk_price, 'exit_call', stock, stk_hold)
 		if target is not None:
-			logging.info('Selling call on %s with strike %f and expiry %s for price %f', ticker, target['strike'], str(target['expiry']), target['price'])
+			logging.info('Selling call on %s with strike %f and expiry %s for price %f', ticker, target['strike'], target['expiry'], target['price'], extra={'ticker': ticker})
 			# append target dict for easy sending to ibif
 			target['ticker'] = ticker
 			target['quantity'] = int(quantity)
 			target['right'] = 'C'
 			target['action'] = 'SELL'
-			order_id = self.ibif.place_option_order(**target)
-			# append with bookkeeping attributes for order monitoring
-			target['id'] = order_id
-			target['loop_cnt'] = 0
-			target['mod_cnt'] = 0
-			self.call_order_list.append(target)
+			# queue for the batch sent at the end of this pass over the universe
+			self.queue_order(target)
 		else:
 			logging.warning('No suitable strangle call found to sell for %s', ticker)
 
@@ -417,9 +769,9 @@ class OptionSeller:
 	def search_for_option(self, ticker, stk_price, strategy, stock, stk_hold=None):
 		date_list = self.ibif.get_expiries(ticker)
 		# Only get expiries that are one month or less away
-		date_list = [date for date in date_list if (date - datetime.datetime.now().date()).days <= 31]
+		date_list = [date for date in date_list if (date - datetime.datetime.now().date()).days <= OPTION_MAX_DAYS]
 		date_list.sort()
-		logging.debug('Looking for options on the following dates: ' + str(date_list))
+		logging.debug('Looking for options on the following dates: %s', date_list, extra={'ticker': ticker})
 		# Set right to use for contracts
 		if strategy == 'exit_call' or strategy == 'strangle_call':
 			right = 'C'
@@ -428,14 +780,14 @@ class OptionSeller:
 		# Initialize target result to None
 		target = None
 		for expiry in date_list:
-			logging.debug('On expiry ' + str(expiry))
+			logging.debug('On expiry %s', expiry, extra={'ticker': ticker})
 			# Get available strikes
 			strike_list = self.ibif.get_strikes(ticker, expiry)
 			# find the best strike to use from the list.  Criteria changes based on the strategy being implemented
 			strike = self.find_best_strike(stk_price, strike_list, strategy, stock, stk_hold)
 			# Quote the selected option
 			opt_quote = self.ibif.get_option_quote(ticker, expiry, right, strike)
-			logging.debug('Quote for this option: ' + str(opt_quote))
+			logging.debug('Quote for this option: %s', opt_quote, extra={'ticker': ticker})
 			# offer = round((opt_quote['bid'] + opt_quote['ask'])/2.0)
 			if all(value == None for value in opt_quote.values()):
 				logging.error('Empty quote returned.  Possible problem with data connection. Skipping this strike')
@@ -488,14 +840,14 @@ class OptionSeller:
 				# If we have unrealized profit, sell at first strike above current price
 				return min(s for s in strike_list if s > stk_price)
 		elif strategy == 'exit_call':
-			if stk_price > stock['targetSell']:
+			if stk_price > stock.target_sell:
 				# Highest ITM call if we are above target
 				return max(s for s in strike_list if s < stk_price)
 			else:
 				# Lowest OTM call if we are below target
 				return min(s for s in strike_list if s >= stk_price)
 		elif strategy == 'put':
-			if stk_price > stock['targetBuy']:
+			if stk_price > stock.target_buy:
 				# Highest OTM put if we are above target
 				return max(s for s in strike_list if s <= stk_price)
 			else:
@@ -503,22 +855,73 @@ class OptionSeller:
 				return min(s for s in strike_list if s > stk_price)
 
 	# Shut down the option seller
+	# Working orders are left in place.  They stay in the journal and are picked up again on the next start
 	def shut_down(self):
 		self.trade = False
 		self.trade_thread.join()
+		self.journal.close()
 		self.ibif.shut_down()
 
 
+# Read the global conf file.  A missing file or option falls back to the defaults in the code
+def load_global_conf(path=GLOBAL_CONF):
+	conf = configparser.ConfigParser()
+	conf.read(path)
+	return conf
+
+# Strategy plugins that can be named in the global conf file
+STRATEGY_CLASSES = {'OptionSeller': OptionSeller}
+
+# List of (strategy class, name, keyword arguments) for the strategies in the global conf file, one per
+# [strategy <name>] section.  Without any, a single OptionSeller runs on the default stock csv and journal
+def load_strategies(conf):
+	strategies = []
+	for section in conf.sections():
+		if not section.startswith('strategy '):
+			continue
+		name = section[len('strategy '):].strip()
+		class_name = conf.get(section, 'class', fallback='OptionSeller')
+		if class_name not in STRATEGY_CLASSES:
+			raise ValueError('Unknown strategy class %s for strategy %s' % (class_name, name))
+		kwargs = {'stock_csv': conf.get(section, 'stock_csv', fallback=STOCK_CSV),
+				'journal_file': conf.get(section, 'journal', fallback=name + '.journal')}
+		strategies.append((STRATEGY_CLASSES[class_name], name, kwargs))
+	if not strategies:
+		strategies.append((OptionSeller, STRATEGY_NAME, {'stock_csv': STOCK_CSV, 'journal_file': JOURNAL_FILE}))
+	return strategies
+
 def main():
+	# Set up logging before anything else logs.  Level, json lines output, and log file come from the global conf file
+	conf = load_global_conf()
+	configure_logging(level=conf.get('logging', 'level', fallback=LOG_LEVEL),
+					structured=conf.getboolean('logging', 'structured', fallback=False),
+					log_file=conf.get('logging', 'file', fallback=None))
 	try:
-		ops = OptionSeller()
+		# One interface and data layer, shared by every strategy
+		ops = StrategyEngine(client_id=IB_CLIENT_ID, num_clients=IB_NUM_CLIENTS, max_collateral=MAX_COLLATERAL)
+		for strategy_class, name, kwargs in load_strategies(conf):
+			ops.add_strategy(strategy_class, name, **kwargs)
+		# Diagnostics on SIGUSR1, and optionally a profile of the whole run
+		diagnostics = Diagnostics(ops.ibif, profile_file=conf.get('diagnostics', 'profile_file', fallback=PROFILE_FILE),
+								profile_interval=conf.getfloat('diagnostics', 'profile_interval', fallback=PROFILE_INTERVAL))
+		if conf.getboolean('diagnostics', 'signal', fallback=True):
+			diagnostics.install_signal()
+		if conf.getboolean('diagnostics', 'profile', fallback=False):
+			diagnostics.start_profiler()
+		# State of every strategy over http, for dashboards
+		if conf.getboolean('monitor', 'enabled', fallback=False):
+			try:
+				MonitorServer(ops.data.monitor_state, host=conf.get('monitor', 'host', fallback=MONITOR_HOST),
+							port=conf.getint('monitor', 'port', fallback=MONITOR_PORT))
+			except OSError:
+				logging.exception('Monitor could not be started.  Running without it.')
 		while True:
 			time.sleep(.1)
 	except KeyboardInterrupt:
 		logging.warning('Received keyboard interrupt.  Exiting gracefully...')
 		ops.shut_down()
 	except:
-		logging.warning('Unexpected error. Shutting it down...')
+		logging.exception('Unexpected error. Shutting it down...')
 		ops.shut_down()
 
 
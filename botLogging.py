@@ -0,0 +1,87 @@
+# Logging setup for the bot
+# Records are handed off to a queue on the calling thread, and formatted and written by a background listener thread,
+# so the trading thread never waits on log I/O.  Records can be written as plain text or as JSON lines, with
+# per-ticker and per-order fields passed through the extra argument, e.g.
+#   logging.info('Placed order %d', order_id, extra={'ticker': ticker, 'order_id': order_id})
+
+# python logging library for monitoring and debugging
+import logging
+import logging.handlers
+# queue between the logging callers and the writer thread
+import queue
+# stop the writer thread at exit so the queue is flushed
+import atexit
+# json lines output
+import json
+import datetime
+
+# Plain text format, matching what the bot has always printed
+TEXT_FORMAT = '%(levelname)s:%(message)s'
+
+# Fields passed through extra that are written as their own keys in json lines output
+STRUCTURED_FIELDS = ('ticker', 'order_id', 'order_ref', 'client_id', 'req_id', 'strategy')
+
+# Formats records as single line json objects
+class JsonFormatter(logging.Formatter):
+	def format(self, record):
+		rec = {
+			'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+			'level': record.levelname,
+			'thread': record.threadName,
+			'msg': record.getMessage(),
+		}
+		for field in STRUCTURED_FIELDS:
+			value = getattr(record, field, None)
+			if value is not None:
+				rec[field] = value
+		if record.exc_info:
+			rec['exc'] = self.formatException(record.exc_info)
+		return json.dumps(rec, default=str)
+
+# Queue handler that leaves message formatting to the listener thread
+# The stock QueueHandler formats every record on the calling thread, which is the cost we're trying to avoid.
+# Arguments that are containers could change before the listener gets to them, so only those records are formatted here
+class LazyQueueHandler(logging.handlers.QueueHandler):
+	def prepare(self, record):
+		args = record.args
+		if args and not isinstance(args, tuple):
+			args = (args,)
+		if args and any(isinstance(arg, (list, dict, set)) for arg in args):
+			record.msg = record.getMessage()
+			record.args = None
+		return record
+
+# Convert a level name like INFO or a number to a logging level
+def parse_level(level):
+	if isinstance(level, int):
+		return level
+	if level.strip().isdigit():
+		return int(level)
+	value = logging.getLevelName(level.strip().upper())
+	if not isinstance(value, int):
+		raise ValueError('Unknown log level %s' % level)
+	return value
+
+# Set up the root logger with a queue-backed background writer
+# level is a level name or number.  structured selects json lines output, and log_file writes to a file instead of stderr
+# Returns the listener, which is also stopped automatically at exit
+def configure_logging(level='INFO', structured=False, log_file=None):
+	if log_file:
+		target = logging.FileHandler(log_file)
+	else:
+		target = logging.StreamHandler()
+	if structured:
+		target.setFormatter(JsonFormatter())
+	else:
+		target.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+	log_queue = queue.Queue(-1)
+	listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+	root = logging.getLogger()
+	for handler in list(root.handlers):
+		root.removeHandler(handler)
+	root.addHandler(LazyQueueHandler(log_queue))
+	root.setLevel(parse_level(level))
+	listener.start()
+	atexit.register(listener.stop)
+	return listener
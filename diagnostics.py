@@ -0,0 +1,151 @@
+# Runtime diagnostics for a live bot
+# Sending SIGUSR1 to the process logs the stack of every thread and the requests the IB interface has in flight, and
+# starts the sampling profiler, or stops it and writes its output if it is already running.  The profiler can also be
+# started at launch from the global conf file.
+# Profiles are written as collapsed stacks, one "frame;frame;frame count" line per stack, which flamegraph.pl and
+# speedscope read directly.
+
+# stacks of running threads
+import sys
+import traceback
+import threading
+import time
+# trigger from outside the process
+import signal
+# write out a running profile at exit
+import atexit
+# python logging library for monitoring and debugging
+import logging
+
+# Default collapsed stack output file, and time between profiler samples in seconds
+PROFILE_FILE = 'profile.folded'
+PROFILE_INTERVAL = .01
+
+# Samples the stacks of all threads at a fixed interval on a background thread, and counts identical stacks
+# Sampling from outside the profiled threads keeps the overhead low, and nothing changes in the code being profiled
+class SamplingProfiler:
+	def __init__(self, interval=PROFILE_INTERVAL):
+		self.interval = interval
+		self.counts = {}
+		self.sample_cnt = 0
+		self.stop_event = threading.Event()
+		self.thread = None
+
+	def running(self):
+		return self.thread is not None
+
+	def start(self):
+		self.counts = {}
+		self.sample_cnt = 0
+		self.stop_event.clear()
+		self.thread = threading.Thread(target=self._sample_loop, name='SamplingProfiler')
+		self.thread.daemon = True
+		self.thread.start()
+
+	# Stop sampling and write the collapsed stacks to path
+	def stop(self, path=PROFILE_FILE):
+		self.stop_event.set()
+		self.thread.join()
+		self.thread = None
+		with open(path, 'w') as profile_file:
+			for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+				profile_file.write('%s %d\n' % (stack, count))
+
+	def _sample_loop(self):
+		own_id = threading.get_ident()
+		while not self.stop_event.wait(self.interval):
+			names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_id:
+					continue
+				stack = collapse_stack(names.get(thread_id, str(thread_id)), frame)
+				self.counts[stack] = self.counts.get(stack, 0) + 1
+			self.sample_cnt = self.sample_cnt + 1
+
+# Collapse a stack into a single line, outermost frame first, starting with the thread name
+def collapse_stack(thread_name, frame):
+	frames = []
+	while frame is not None:
+		code = frame.f_code
+		frames.append('%s:%s:%d' % (code.co_filename.rsplit('/', 1)[-1], code.co_name, code.co_firstlineno))
+		frame = frame.f_back
+	frames.append(thread_name.replace(' ', '_'))
+	return ';'.join(reversed(frames))
+
+# Log the stack of every thread
+def dump_threads():
+	names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+	for thread_id, frame in sys._current_frames().items():
+		logging.info('Stack of thread %s:\n%s', names.get(thread_id, thread_id), ''.join(traceback.format_stack(frame)))
+
+# Diagnostics for a running bot.  Requests are handled on a thread of their own rather than in the signal handler,
+# so they never run in the middle of whatever the main thread was doing
+class Diagnostics:
+	def __init__(self, ibif, profile_file=PROFILE_FILE, profile_interval=PROFILE_INTERVAL):
+		self.ibif = ibif
+		self.profile_file = profile_file
+		self.profiler = SamplingProfiler(profile_interval)
+		self.start_time = None
+		self.request_event = threading.Event()
+		self.thread = threading.Thread(target=self._request_loop, name='Diagnostics')
+		self.thread.daemon = True
+		self.thread.start()
+		atexit.register(self.shut_down)
+
+	# Handle diagnostics requests on SIGUSR1.  Must be called from the main thread.  Returns False where the
+	# platform has no SIGUSR1
+	def install_signal(self):
+		signum = getattr(signal, 'SIGUSR1', None)
+		if signum is None:
+			logging.warning('SIGUSR1 not available.  Diagnostics can only be started from the conf file')
+			return False
+		signal.signal(signum, self._signal_handler)
+		return True
+
+	def _signal_handler(self, signum, frame):
+		self.request_event.set()
+
+	def _request_loop(self):
+		while True:
+			self.request_event.wait()
+			self.request_event.clear()
+			try:
+				self.run()
+			except Exception:
+				logging.exception('Diagnostics failed')
+
+	# Dump threads and in flight requests, and toggle the profiler
+	def run(self):
+		logging.info('Diagnostics requested')
+		dump_threads()
+		self.dump_inflight()
+		self.toggle_profiler()
+
+	# Log every request the IB interface is waiting on, oldest first
+	def dump_inflight(self):
+		requests = self.ibif.get_inflight_requests()
+		logging.info('%d requests in flight', len(requests))
+		for key, client_id, age in requests:
+			logging.info('In flight: %s on client %d for %.1f seconds', str(key), client_id, age)
+
+	# Start the profiler, or stop it and write its output
+	def toggle_profiler(self):
+		if self.profiler.running():
+			self.stop_profiler()
+		else:
+			self.start_profiler()
+
+	def start_profiler(self):
+		logging.info('Starting sampling profiler, %.1f ms between samples', self.profiler.interval*1000)
+		self.start_time = time.time()
+		self.profiler.start()
+
+	# Write out the profile if the profiler is still running
+	def shut_down(self):
+		if self.profiler.running():
+			self.stop_profiler()
+
+	def stop_profiler(self):
+		self.profiler.stop(self.profile_file)
+		logging.info('Stopped sampling profiler after %.1f seconds, %d samples written to %s',
+					time.time() - self.start_time, self.profiler.sample_cnt, self.profile_file)
@@ -0,0 +1,187 @@
+# Running totals of the collateral and exposure of the portfolio
+# Positions and working orders are fed in as they change, and every total is adjusted by the change alone, so the
+# pre-trade checks cost the same no matter how many names and orders the bot has.
+
+# python logging library for monitoring and debugging
+import logging
+# several strategies update the totals from their own threads
+from threading import RLock
+
+# Shares per option contract
+MULTIPLIER = 100
+
+# Exposure of a single ticker
+# Option quantities are signed like IB positions, so short contracts are negative.  Short and order counts are in
+# contracts and always positive.  put_held and call_held count the option contracts (strike and expiry) with a
+# position, long or short, so offsetting legs that net to zero still count as held
+class TickerExposure:
+	__slots__ = ('shares', 'put_qty', 'call_qty', 'short_puts', 'short_calls', 'put_orders', 'call_orders', 'covered_calls',
+				'uncovered_calls', 'put_held', 'call_held')
+
+	def __init__(self):
+		for attr in self.__slots__:
+			setattr(self, attr, 0)
+
+class ExposureEngine:
+	# max_collateral is the fraction of NetLiquidation that cash-secured puts may tie up
+	def __init__(self, max_collateral=1.0):
+		self.max_collateral = max_collateral
+		self.net_liquidation = None
+		# exposure keyed by ticker, last position quantity and strike keyed by contract, and working sell orders
+		# keyed by order reference
+		self.exposures = {}
+		self.positions = {}
+		self.orders = {}
+		# portfolio totals.  Collateral is the cash needed if every short put and working put order were assigned
+		self.collateral = 0.0
+		self.covered_calls = 0
+		self.uncovered_calls = 0
+		self.lock = RLock()
+
+	def _exposure(self, ticker):
+		exposure = self.exposures.get(ticker)
+		if exposure is None:
+			exposure = self.exposures[ticker] = TickerExposure()
+		return exposure
+
+	# Set NetLiquidation from the account value.  None, e.g. from a timed out request, keeps the last known value
+	def set_net_liquidation(self, value):
+		if value is not None:
+			self.net_liquidation = float(value)
+
+	# Apply a position list from the ib interface.  Only positions whose quantity changed since the last list touch
+	# the totals
+	def update_positions(self, position_list):
+		with self.lock:
+			self._update_positions(position_list)
+
+	def _update_positions(self, position_list):
+		current = {}
+		for pos in position_list:
+			if pos['type'] == 'OPT':
+				key = (pos['ticker'], 'OPT', pos['right'], pos['expiry'], pos['strike'])
+			else:
+				key = (pos['ticker'], pos['type'], None, None, None)
+			current[key] = current.get(key, 0) + int(pos['quantity'])
+		for key, quantity in current.items():
+			if quantity != self.positions.get(key, 0):
+				self._apply_position(key, self.positions.get(key, 0), quantity)
+		for key in [key for key in self.positions if key not in current]:
+			self._apply_position(key, self.positions[key], 0)
+
+	# Adjust the totals for one position changing from old to new quantity
+	def _apply_position(self, key, old, new):
+		ticker, sec_type, right, expiry, strike = key
+		exposure = self._exposure(ticker)
+		short_change = max(0, -new) - max(0, -old)
+		held_change = (new != 0) - (old != 0)
+		if sec_type == 'STK':
+			exposure.shares = exposure.shares + new - old
+		elif right == 'P':
+			exposure.put_qty = exposure.put_qty + new - old
+			exposure.put_held = exposure.put_held + held_change
+			exposure.short_puts = exposure.short_puts + short_change
+			self.collateral = self.collateral + short_change*strike*MULTIPLIER
+		elif right == 'C':
+			exposure.call_qty = exposure.call_qty + new - old
+			exposure.call_held = exposure.call_held + held_change
+			exposure.short_calls = exposure.short_calls + short_change
+		if new == 0:
+			self.positions.pop(key, None)
+		else:
+			self.positions[key] = new
+		self._update_coverage(exposure)
+
+	# Split the short calls of a ticker, working orders included, into covered and uncovered, and adjust the totals
+	def _update_coverage(self, exposure):
+		short_calls = exposure.short_calls + exposure.call_orders
+		covered = min(short_calls, max(0, exposure.shares) // MULTIPLIER)
+		uncovered = short_calls - covered
+		self.covered_calls = self.covered_calls + covered - exposure.covered_calls
+		self.uncovered_calls = self.uncovered_calls + uncovered - exposure.uncovered_calls
+		exposure.covered_calls = covered
+		exposure.uncovered_calls = uncovered
+
+	# Count a working order.  Only sell orders add exposure.  Orders are keyed by order reference, so adding the same
+	# order again, e.g. after a modification, replaces it
+	def add_order(self, order):
+		if order.get('action') != 'SELL':
+			return
+		with self.lock:
+			self.remove_order(order)
+			rec = (order['ticker'], order['right'], float(order['strike']), int(order['quantity']))
+			self.orders[order['order_ref']] = rec
+			self._apply_order(rec, 1)
+
+	# Stop counting an order that is no longer working
+	def remove_order(self, order):
+		with self.lock:
+			rec = self.orders.pop(order.get('order_ref'), None)
+			if rec is not None:
+				self._apply_order(rec, -1)
+
+	def _apply_order(self, rec, sign):
+		ticker, right, strike, quantity = rec
+		exposure = self._exposure(ticker)
+		if right == 'P':
+			exposure.put_orders = exposure.put_orders + sign*quantity
+			self.collateral = self.collateral + sign*quantity*strike*MULTIPLIER
+		else:
+			exposure.call_orders = exposure.call_orders + sign*quantity
+			self._update_coverage(exposure)
+
+	# Signed put and call quantities held for ticker, as summed from the positions
+	def put_position(self, ticker):
+		exposure = self.exposures.get(ticker)
+		return exposure.put_qty if exposure is not None else 0
+
+	def call_position(self, ticker):
+		exposure = self.exposures.get(ticker)
+		return exposure.call_qty if exposure is not None else 0
+
+	# Check whether any put or call position, long or short, is held on ticker
+	def holds_puts(self, ticker):
+		exposure = self.exposures.get(ticker)
+		return exposure is not None and exposure.put_held > 0
+
+	def holds_calls(self, ticker):
+		exposure = self.exposures.get(ticker)
+		return exposure is not None and exposure.call_held > 0
+
+	# Shares held plus the shares that short puts and working put orders would add if assigned
+	def committed_shares(self, ticker):
+		exposure = self.exposures.get(ticker)
+		if exposure is None:
+			return 0
+		return exposure.shares + (exposure.short_puts + exposure.put_orders)*MULTIPLIER
+
+	# Check whether selling quantity puts at strike on ticker fits the collateral limit and the weight target
+	# Logs the reason and returns False if it doesn't.  If order is given and fits, it is added in the same step, so two
+	# strategies can't both fit an order into the same room
+	def check_put(self, ticker, strike, quantity, weight_target=None, order=None):
+		with self.lock:
+			if not self._check_put(ticker, strike, quantity, weight_target):
+				return False
+			if order is not None:
+				self.add_order(order)
+			return True
+
+	def _check_put(self, ticker, strike, quantity, weight_target):
+		if self.net_liquidation is None:
+			logging.warning('NetLiquidation unknown.  Not selling puts on %s', ticker, extra={'ticker': ticker})
+			return False
+		needed = self.collateral + strike*quantity*MULTIPLIER
+		if needed > self.net_liquidation*self.max_collateral:
+			logging.warning('Selling %d puts on %s would take collateral to %.2f, over the limit of %.2f', quantity, ticker,
+							needed, self.net_liquidation*self.max_collateral, extra={'ticker': ticker})
+			return False
+		if weight_target is not None and self.committed_shares(ticker) + quantity*MULTIPLIER > weight_target:
+			logging.warning('Selling %d puts on %s would commit %d shares, over the weight target of %d', quantity, ticker,
+							self.committed_shares(ticker) + quantity*MULTIPLIER, weight_target, extra={'ticker': ticker})
+			return False
+		return True
+
+	# Portfolio totals, for logging
+	def summary(self):
+		return {'net_liquidation': self.net_liquidation, 'collateral': self.collateral,
+				'covered_calls': self.covered_calls, 'uncovered_calls': self.uncovered_calls, 'orders': len(self.orders)}
@@ -0,0 +1,98 @@
+# Record of every fill of the account's orders, built from the execution and commission reports TWS/Gateway pushes
+# Fills are indexed by order, ticker and trade date as they arrive, so fill quantities and costs are answered from
+# memory instead of polling each order.
+
+# date operations
+import datetime
+# python logging library for monitoring and debugging
+import logging
+# fills are added by the reader thread and read by the trading threads
+from threading import Lock
+
+# Value IB sends for realized PNL when it isn't known yet
+UNSET_DOUBLE = 1.7976931348623157e308
+
+# Fills keyed by execution id, with an index of execution ids for each order, ticker and trade date
+# A fill is a dict with the exec_id, order_id, perm_id, order_ref, ticker, type, action ('BUY' or 'SELL'), quantity,
+# price, time, and for options the right, expiry and strike.  commission and realized_pnl are None until the
+# commission report for the fill arrives
+class FillLedger:
+	def __init__(self):
+		self.fills = {}
+		self.order_index = {}
+		self.ticker_index = {}
+		self.day_index = {}
+		# commission reports that arrived before their execution, keyed by execution id
+		self.pending_commissions = {}
+		self.lock = Lock()
+
+	# Add a fill.  Returns True if it is new.  The same execution arrives again from every catch-up request and is
+	# ignored, while a correction, whose id only differs after the last dot, replaces the fill it corrects
+	def add_fill(self, fill):
+		exec_id = fill['exec_id']
+		base_id = exec_id.rsplit('.', 1)[0]
+		with self.lock:
+			if exec_id in self.fills:
+				return False
+			for old_id in [old_id for old_id in self.order_index.get(fill['order_id'], ()) if old_id.rsplit('.', 1)[0] == base_id]:
+				logging.info('Execution %s corrected by %s', old_id, exec_id, extra={'order_id': fill['order_id']})
+				self._remove(old_id)
+			fill.setdefault('commission', None)
+			fill.setdefault('realized_pnl', None)
+			commission = self.pending_commissions.pop(exec_id, None)
+			if commission is not None:
+				fill['commission'], fill['realized_pnl'] = commission
+			self.fills[exec_id] = fill
+			self.order_index.setdefault(fill['order_id'], []).append(exec_id)
+			self.ticker_index.setdefault(fill['ticker'], []).append(exec_id)
+			self.day_index.setdefault(fill['time'].date(), []).append(exec_id)
+		logging.info('Fill: %s %d %s at %.2f on order %d', fill['action'], fill['quantity'], fill['ticker'], fill['price'],
+					fill['order_id'], extra={'ticker': fill['ticker'], 'order_id': fill['order_id']})
+		return True
+
+	def _remove(self, exec_id):
+		fill = self.fills.pop(exec_id)
+		self.order_index[fill['order_id']].remove(exec_id)
+		self.ticker_index[fill['ticker']].remove(exec_id)
+		self.day_index[fill['time'].date()].remove(exec_id)
+
+	# Attach a commission report to its fill.  realized_pnl is None if IB doesn't know it yet
+	def add_commission(self, exec_id, commission, realized_pnl=None):
+		if realized_pnl is not None and realized_pnl >= UNSET_DOUBLE:
+			realized_pnl = None
+		with self.lock:
+			fill = self.fills.get(exec_id)
+			if fill is None:
+				self.pending_commissions[exec_id] = (commission, realized_pnl)
+				return
+			fill['commission'] = commission
+			fill['realized_pnl'] = realized_pnl
+
+	# Copies of the fills for an order, a ticker, or a trade date, oldest first
+	def order_fills(self, order_id):
+		return self._fills(self.order_index.get(order_id, ()))
+
+	def ticker_fills(self, ticker, day=None):
+		fills = self._fills(self.ticker_index.get(ticker, ()))
+		if day is not None:
+			fills = [fill for fill in fills if fill['time'].date() == day]
+		return fills
+
+	def day_fills(self, day=None):
+		if day is None:
+			day = datetime.date.today()
+		return self._fills(self.day_index.get(day, ()))
+
+	def _fills(self, exec_ids):
+		with self.lock:
+			fills = [dict(self.fills[exec_id]) for exec_id in exec_ids]
+		return sorted(fills, key=lambda fill: fill['time'])
+
+	# Number of contracts or shares filled so far on an order
+	def filled_quantity(self, order_id):
+		with self.lock:
+			return sum(self.fills[exec_id]['quantity'] for exec_id in self.order_index.get(order_id, ()))
+
+	# Total commission of the fills on a trade date.  Fills still waiting for their report count as nothing
+	def day_commission(self, day=None):
+		return sum(fill['commission'] or 0 for fill in self.day_fills(day))
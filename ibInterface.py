@@ -1,19 +1,26 @@
 # Helper functions for extracting data from TWS/gateway messages
 from ib.ext.Contract import Contract
 from ib.ext.Order import Order
+from ib.ext.ExecutionFilter import ExecutionFilter
 from ib.opt import ibConnection, message
+# compact storage for option chains
+from optionChain import OptionChain
+# read-only versions of data shared between the reader thread and the trading threads
+from snapshots import DictSnapshot, BufferedSnapshot
+# fills indexed by order, ticker and day
+from fillLedger import FillLedger
 
 import time
 import datetime
-from threading import Thread
-import signal
+import collections
+import functools
+# stable hash of tickers for spreading requests across connections
+import zlib
+from threading import Thread, Condition, Lock, RLock, Event
 
 # python logging library for monitoring and debugging
 import logging
 
-# Set logging level
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-
 # Reference codes for tick numbers on messages from TWS/Gateway
 # Copied relevant codes ib.ext.TickType, can't get it to import properly for some reason
 class TickTypes:
@@ -31,56 +38,164 @@ class TickTypes:
 	OPTION_CALL_OPEN_INTEREST = 27
 	OPTION_PUT_OPEN_INTEREST = 28
 
+# Order statuses pushed by TWS/Gateway that mean an order is done working
+CANCELLED_STATUSES = ('Cancelled', 'cancelled', 'ApiCancelled')
+FILLED_STATUSES = ('Filled', 'filled')
+FINAL_STATUSES = CANCELLED_STATUSES + FILLED_STATUSES + ('Inactive',)
+
+# Error codes that TWS/Gateway sends in place of a status when an order can't be placed or cancelled
+# 135: can't find order, 161: cancel attempted when order is not cancellable, 201: order rejected, 10147: order to cancel not found
+ORDER_ERROR_CODES = (135, 161, 201, 10147)
+
+# Error codes for connectivity between TWS/Gateway and the IB servers, sent around the nightly reset and Gateway restarts
+# 1100: connectivity lost, 1101: restored with market data lost, 1102: restored with market data maintained
+CONNECTIVITY_LOST = 1100
+CONNECTIVITY_RESTORED_DATA_LOST = 1101
+CONNECTIVITY_RESTORED = 1102
+
+# Error code sent in place of contract details when nothing matches the request, e.g. a month without expiries
+NO_SECURITY_DEFINITION = 200
+
+# Fields returned for stock and option quotes
+STOCK_QUOTE_FIELDS = ('bid', 'ask', 'last', 'volume', 'close')
+OPTION_QUOTE_FIELDS = ('bid', 'ask', 'last', 'close', 'open', 'volume')
+
+# Fields a quote needs before it is complete, as groups of which any one field will do
+# QUOTE_PRICING needs both sides of the market, QUOTE_REFERENCE a last or closing price
+QUOTE_PRICING = (('bid',), ('ask',))
+QUOTE_REFERENCE = (('last', 'close'),)
+STOCK_QUOTE_READY = QUOTE_PRICING + QUOTE_REFERENCE
+OPTION_QUOTE_READY = QUOTE_REFERENCE
+
 # Class to provide a convenient wrapper around the TWS/Gateway message structure
+# client_id is the id of the master connection, which carries orders, positions and account data
+# With num_clients above 1, a pool of connections is opened under the following client ids, and market data and
+# contract detail requests are spread across the whole pool by ticker
 class IbInterface:
-	def __init__(self):
+	def __init__(self, client_id=0, num_clients=1):
 		# Values to be populated by the msg handlers when data received from TWS/Gateway
 		self.account_value = None
-		self.ticker = None
-		self.key = None
-		self.bid = None
-		self.ask = None
-		self.last = None
-		self.volume = None
-		self.close = None
-		self.open_interest = None
-		self.open = None
-		self.order_status = None
-		self.filled_quantity = None
-
-		# list to hold possible options contracts, and ticker associated with contracts
-		self.contract_list = []
-		self.list_ticker = None
-
-		# list to hold open order ids
-		self.open_id_list = []
-
-		# list to hold current positions, populated by the get positions method
-		self.position_list = []
-
-		# indicator that contract details, valid order id, open order id list, position details are ready
-		self.detail_ready = False
+
+		# Quote data being collected, keyed by tick id, and contract detail requests being collected, keyed by detail id
+		# Every quote keeps its fields in a snapshot of (value, update time) pairs, the field groups it needs, and an
+		# event set once they have all arrived
+		self.quote_requests = {}
+		self.detail_requests = {}
+
+		# cached option chains (OptionChain objects) and quotes, served while disconnected.  Chains are keyed by ticker,
+		# stock quotes by ticker, and option quotes by (ticker, expiry, right, strike)
+		self.chain_cache = {}
+		self.chain_max_age = 6*60*60
+
+		# Chains are fetched in parts, one contract detail request per expiry month and right.  chain_parts holds the
+		# fetch time and strike range of every part in the cache, {ticker: {(month, right): (time, strike_min, strike_max)}}
+		# chain_max_days limits the parts to expiries in the strategy's window, None fetches every expiry.
+		# chain_strike_band limits the strikes kept to a fraction around the stock price, None keeps every strike
+		self.chain_parts = {}
+		# Parts whose request timed out, {ticker: {(month, right): (retry time, delay)}}.  They aren't asked for again until
+		# the retry time, and the delay doubles with every timeout in a row, between the min and max in seconds
+		self.chain_failures = {}
+		self.chain_retry_min = 60
+		self.chain_retry_max = 60*60
+		self.chain_max_days = None
+		self.chain_rights = ('P', 'C')
+		self.chain_strike_band = None
+		self.quote_cache = {}
+		# update times of the fields of the last quote received, keyed like the quote cache
+		self.quote_times = {}
+
+		# last known account value and positions, served while disconnected or when a request times out
+		self.last_account_value = None
+		# The account update subscription stays open once started, so it is tracked here rather than as a request in
+		# flight, and re-sent after the master reconnects
+		self.account_subscribed = False
+		self.last_position_list = []
+
+		# details of each open order keyed by id, and current positions keyed by contract
+		# The reader thread collects each run of messages privately and publishes it whole on the end message, so the
+		# trading threads only ever see a complete list
+		self.open_orders = BufferedSnapshot()
+		self.positions = BufferedSnapshot()
+
+		# latest pushed status for every order, and order-related errors, keyed by order id
+		# Statuses are published as snapshots and read without a lock.  Both are updated under order_cond so batch
+		# methods can wait on status messages instead of polling
+		self.order_statuses = DictSnapshot()
+		self.order_error_dict = {}
+		self.order_cond = Condition()
+		# Orders that are done, final status or error, as (time, order id) in the order they finished.  They are dropped
+		# from both dicts after order_status_max_age seconds, so the copy made for every status message only grows with
+		# the working and recently finished orders
+		self.done_orders = collections.deque()
+		self.order_status_max_age = 10*60
+
+		# Every fill of the account's orders, from pushed execution and commission reports.  Execution requests that
+		# haven't seen their end message yet are kept with an event, keyed by request id
+		self.fills = FillLedger()
+		self.execution_requests = {}
+
+		# indicator that a valid order id is ready
 		self.id_ready = False
-		self.open_order_ready = False
-		self.positions_ready = False
 
-		# numeric identifier for market data request, contract detail request, placed order, and order for which status requested
+		# numeric identifier for market data request, contract detail request, and placed order
 		self.tick_id = 1
 		self.detail_id = 1
 		self.order_id = 0
-		self.search_id = None
 
-		# number of possible tick_id numbers and detail_id numbers
+		# number of possible tick_id numbers and detail_id numbers.  Ids are shared by the whole connection pool
 		self.id_max = 1000
+		self.id_lock = Lock()
+		# Held from the order id request until the orders using the ids are sent, so strategies placing orders from
+		# their own threads, and the monitor thread re-syncing the id after a reconnect, never share an id or a reply
+		self.order_id_lock = RLock()
 
-		# timeout for quotes, in seconds, and counter for amount of ticks received for a quote
+		# timeout for quotes, in seconds.  Quotes return as soon as their needed fields arrive, or with what they have at the timeout
 		self.quote_timeout = 10
-		self.stk_tick_max = 5
-		self.opt_tick_max = 5
-		self.tick_cnt = 0
 
-		# Connection to TWS/Gateway
-		self.conn = ibConnection()
+		# Market data lines are limited per account, not per client, so batches of quotes are requested in chunks of this size
+		self.mkt_data_lines = 100
+
+		# Streaming stock quote subscriptions, tick id keyed by ticker.  Subscribed tickers are quoted from the stream
+		# without a new request.  A few lines are always kept free for snapshot requests
+		self.subscriptions = {}
+		self.snapshot_lines = 10
+
+		# timeout for contract details, in seconds
+		self.detail_timeout = 90
+
+		# timeout for batch order placement and cancel confirmations, in seconds
+		self.confirm_timeout = 10
+
+		# timeout for requests that used to wait forever (order ids, positions, account value), in seconds
+		self.request_timeout = 30
+
+		# Requests in flight, keyed by a name for the request.  Each entry holds a function that sends the request,
+		# so market data subscriptions and unanswered requests can be replayed after a reconnect, and whether it was
+		# sent, so requests held while TWS/Gateway had lost the IB servers go out once they are back
+		self.inflight = {}
+
+		# Connection health.  connected is False while the socket is down or TWS/Gateway has lost the IB servers
+		# Reconnect attempts back off exponentially between the min and max delay, in seconds
+		self.connected = False
+		self.health_interval = 5
+		self.reconnect_delay_min = 1
+		self.reconnect_delay_max = 60
+		self.monitor = True
+		self.disconnect_event = Event()
+
+		# IB disconnects clients sending more than 50 messages per second, so outgoing batches are paced below that
+		# The limit applies to each connection, so send times and locks are kept per connection
+		self.msg_rate_max = 45
+		self.msg_times = {}
+		self.pace_locks = {}
+
+		# Connections to TWS/Gateway.  The first one is the master, and the only one used for orders
+		self.client_id = client_id
+		self.conn_pool = [ibConnection(clientId=client_id + i) for i in range(num_clients)]
+		self.conn = self.conn_pool[0]
+		for conn in self.conn_pool:
+			self.msg_times[id(conn)] = collections.deque()
+			self.pace_locks[id(conn)] = Lock()
 
 		# dict to neatly define function calls from the tick handler
 		self.tick_callbacks = {
@@ -100,17 +215,30 @@ class IbInterface:
 								}
 
 		# Configure message handlers and connect
+		# Order, position and account messages are only handled from the master, so order ids and statuses stay consistent
 		self.conn.register(self._account_handler, 'UpdateAccountValue')
-		self.conn.register(self._tick_handler, message.tickSize, message.tickPrice)
-		self.conn.register(self._detail_handler, 'ContractDetails')
-		self.conn.register(self._detail_end_handler, 'ContractDetailsEnd')
 		self.conn.register(self._open_order_handler, 'OpenOrder')
 		self.conn.register(self._open_order_end_handler, 'OpenOrderEnd')
 		self.conn.register(self._order_status_handler, 'OrderStatus')
 		self.conn.register(self._positions_handler, 'Position')
 		self.conn.register(self._positions_end_handler, 'PositionEnd')
+		self.conn.register(self._execution_handler, 'ExecDetails')
+		self.conn.register(self._execution_end_handler, 'ExecDetailsEnd')
+		self.conn.register(self._commission_handler, 'CommissionReport')
 		self.conn.registerAll(self._order_id_handler)
-		self.conn.connect()
+		for conn in self.conn_pool:
+			conn.register(self._tick_handler, message.tickSize, message.tickPrice)
+			conn.register(self._detail_handler, 'ContractDetails')
+			conn.register(self._detail_end_handler, 'ContractDetailsEnd')
+			conn.register(self._error_handler, 'Error')
+			conn.register(functools.partial(self._connection_closed_handler, conn), 'ConnectionClosed')
+			conn.connect()
+		self.connected = self._socket_connected(self.conn)
+
+		# Watch the connection in the background, and reconnect when it drops
+		self.monitor_thread = Thread(target=self._monitor_connection)
+		self.monitor_thread.daemon = True
+		self.monitor_thread.start()
 
 	# Order id handler assignment is not working, so need to hack a way to extract valid id messages from All
 	# Came up with very dirty triple exception hack. Use the fact that valid id messages have only a single key, orderId
@@ -144,18 +272,6 @@ class IbInterface:
 	def _reset_account_data(self):
 		self.account_value = None
 
-	# reset data after it has been parsed to avoid double-reading
-	def _reset_tick_data(self):
-		self.ticker = None
-		self.key = None
-		self.bid = None
-		self.ask = None
-		self.last = None
-		self.volume = None
-		self.open = None
-		self.close = None
-		self.open_interest = None
-
 	# Handler for account information messages
 	def _account_handler(self, msg):
 		if msg.key=='NetLiquidation':
@@ -163,34 +279,105 @@ class IbInterface:
 
 	# Handler for option/stock quote messages
 	def _tick_handler(self, msg):
-		# only handle messages associated with current tick id and for which we have callbacks
-		if msg.field in self.tick_callbacks.keys() and msg.tickerId==self.tick_id:
-			self.tick_callbacks[msg.field](msg)
-			self.tick_cnt = self.tick_cnt + 1
-
-	# Handler for contract detail messages
+		# only handle messages associated with a quote being collected and for which we have callbacks
+		quote = self.quote_requests.get(msg.tickerId)
+		if quote is not None and msg.field in self.tick_callbacks.keys():
+			self.tick_callbacks[msg.field](quote, msg)
+			if not quote['event'].is_set() and self._quote_ready(quote, quote['ready']):
+				quote['event'].set()
+
+	# Handler for contract detail messages.  Strikes outside the band of the request are dropped here, since
+	# contract detail requests can only match a single strike
 	def _detail_handler(self, msg):
-		if msg.reqId==self.detail_id:
-			self.contract_list.append(msg.contractDetails.m_summary)
+		request = self.detail_requests.get(msg.reqId)
+		if request is not None:
+			cont = msg.contractDetails.m_summary
+			if request['strike_min'] is not None and not request['strike_min'] <= cont.m_strike <= request['strike_max']:
+				return
+			request['chain'].add_contract(cont)
 
 	# Handler for the termination of contract details
 	def _detail_end_handler(self, msg):
-		self.detail_ready = True
+		self._detail_ready(msg.reqId)
+
+	# Mark a contract detail request as answered
+	def _detail_ready(self, detail_id):
+		request = self.detail_requests.get(detail_id)
+		if request is not None:
+			request['ready'] = True
 
 	# Handler for open orders
 	def _open_order_handler(self, msg):
-		self.open_id_list.append(msg.orderId)	
+		cont = msg.contract
+		order = msg.order
+		order_dict = {
+					'ticker' : cont.m_symbol,
+					'action' : order.m_action,
+					'price' : order.m_lmtPrice,
+					'quantity' : order.m_totalQuantity,
+					'order_ref' : order.m_orderRef
+		}
+		if cont.m_secType == 'OPT':
+			order_dict['right'] = cont.m_right
+			order_dict['expiry'] = datetime.datetime.strptime(cont.m_expiry, "%Y%m%d").date()
+			order_dict['strike'] = cont.m_strike
+		self.open_orders.add(msg.orderId, order_dict)
 
 	# Handler for the end of open order messages
 	def _open_order_end_handler(self, msg):
-		self.open_order_ready = True
+		self.open_orders.end()
 
 	# Handler for order status messages
 	def _order_status_handler(self, msg):
-		if self.search_id is not None:
-			if self.search_id == msg.orderId:
-				self.filled_quantity = msg.filled
-				self.order_status = msg.status
+		with self.order_cond:
+			self._prune_done_orders()
+			self.order_statuses.set(msg.orderId, {'status': msg.status, 'filled': msg.filled})
+			if msg.status in FINAL_STATUSES:
+				self.done_orders.append((time.time(), msg.orderId))
+			self.order_cond.notify_all()
+
+	# Drop the statuses and errors of orders that finished more than order_status_max_age ago.  Called with order_cond
+	# held.  An order modified or re-sent after finishing is kept until it finishes again
+	def _prune_done_orders(self):
+		cutoff = time.time() - self.order_status_max_age
+		expired = []
+		while self.done_orders and self.done_orders[0][0] < cutoff:
+			expired.append(self.done_orders.popleft()[1])
+		if not expired:
+			return
+		statuses = self.order_statuses.value()
+		expired = [order_id for order_id in expired if order_id in self.order_error_dict or
+					(order_id in statuses and statuses[order_id]['status'] in FINAL_STATUSES)]
+		self.order_statuses.pop_all(expired)
+		for order_id in expired:
+			self.order_error_dict.pop(order_id, None)
+
+	# Handler for error messages.  Order errors are recorded, so batch waits don't run to timeout on dead orders,
+	# and connectivity errors update the connection state
+	def _error_handler(self, msg):
+		if msg.errorCode == CONNECTIVITY_LOST:
+			logging.warning('TWS/Gateway lost connectivity to IB.  Serving cached data until it is restored.')
+			self.connected = False
+		elif msg.errorCode == CONNECTIVITY_RESTORED:
+			# Subscriptions survived, but requests made while connectivity was lost were only recorded
+			logging.info('TWS/Gateway connectivity to IB restored.  Sending requests held while it was lost.')
+			self.connected = True
+			self._replay_requests(held_only=True)
+		elif msg.errorCode == CONNECTIVITY_RESTORED_DATA_LOST:
+			logging.info('TWS/Gateway connectivity to IB restored with data lost.  Replaying requests.')
+			self.connected = True
+			self._replay_requests()
+		elif msg.errorCode == NO_SECURITY_DEFINITION and msg.id in self.detail_requests:
+			# The request is answered, with no contracts, so the empty part gets cached like any other
+			logging.debug('No contracts for detail request %d: %s', msg.id, msg.errorMsg)
+			self._detail_ready(msg.id)
+		elif msg.errorCode in ORDER_ERROR_CODES:
+			logging.warning('Order error %d on order id %d: %s', msg.errorCode, msg.id, msg.errorMsg, extra={'order_id': msg.id})
+			with self.order_cond:
+				self._prune_done_orders()
+				self.order_error_dict[msg.id] = msg.errorCode
+				self.done_orders.append((time.time(), msg.id))
+				self.order_cond.notify_all()
 
 	# Handler for current position data
 	def _positions_handler(self, msg):
@@ -204,30 +391,210 @@ class IbInterface:
 			pos['right'] = cont.m_right
 			pos['expiry'] = datetime.datetime.strptime(cont.m_expiry, "%Y%m%d").date()
 			pos['strike'] = cont.m_strike
-		self.position_list.append(pos)
+		self.positions.add((msg.account, pos['ticker'], pos['type'], pos.get('right'), pos.get('expiry'), pos.get('strike')), pos)
 
 	# Handler for the end of position messages
 	def _positions_end_handler(self, msg):
-		self.positions_ready = True
+		self.positions.end()
+
+	# Handler for execution reports.  They are pushed for every fill of an order placed by this client, and sent for
+	# every fill of the day in answer to an execution request
+	def _execution_handler(self, msg):
+		cont = msg.contract
+		execution = msg.execution
+		fill = {
+				'exec_id' : execution.m_execId,
+				'order_id' : execution.m_orderId,
+				'perm_id' : execution.m_permId,
+				'order_ref' : execution.m_orderRef,
+				'ticker' : cont.m_symbol,
+				'type' : cont.m_secType,
+				'action' : 'BUY' if execution.m_side == 'BOT' else 'SELL',
+				'quantity' : int(execution.m_shares),
+				'price' : execution.m_price,
+				# times come as 'YYYYMMDD  HH:MM:SS' in the time zone TWS/Gateway runs in
+				'time' : datetime.datetime.strptime(' '.join(execution.m_time.split()), '%Y%m%d %H:%M:%S')
+		}
+		if cont.m_secType == 'OPT':
+			fill['right'] = cont.m_right
+			fill['expiry'] = datetime.datetime.strptime(cont.m_expiry, "%Y%m%d").date()
+			fill['strike'] = cont.m_strike
+		self.fills.add_fill(fill)
+
+	# Handler for the end of the executions sent for an execution request
+	def _execution_end_handler(self, msg):
+		self._end_request(('executions', msg.reqId))
+		done = self.execution_requests.pop(msg.reqId, None)
+		if done is not None:
+			done.set()
+
+	# Handler for commission reports, which follow each execution report
+	def _commission_handler(self, msg):
+		report = msg.commissionReport
+		self.fills.add_commission(report.m_execId, report.m_commission, report.m_realizedPNL)
+
+	# Handler for a socket to TWS/Gateway closing.  Wakes the monitor thread so it can reconnect right away
+	def _connection_closed_handler(self, conn, msg):
+		logging.warning('Connection to TWS/Gateway closed for client id %d.', self._client_id_of(conn))
+		if conn is self.conn:
+			self.connected = False
+		self.disconnect_event.set()
+
+	# Background loop that checks every connection in the pool, and reconnects with exponential backoff when one is down
+	def _monitor_connection(self):
+		delays = dict((id(conn), self.reconnect_delay_min) for conn in self.conn_pool)
+		next_attempts = dict((id(conn), 0) for conn in self.conn_pool)
+		while self.monitor:
+			self.disconnect_event.wait(min(self.health_interval, self.reconnect_delay_min))
+			self.disconnect_event.clear()
+			if not self.monitor:
+				break
+			for conn in self.conn_pool:
+				if self._socket_connected(conn):
+					delays[id(conn)] = self.reconnect_delay_min
+					continue
+				if conn is self.conn:
+					self.connected = False
+				if next_attempts[id(conn)] == 0:
+					logging.warning('Reconnecting client id %d in %d seconds...', self._client_id_of(conn), delays[id(conn)])
+					next_attempts[id(conn)] = time.time() + delays[id(conn)]
+				if time.time() < next_attempts[id(conn)]:
+					continue
+				next_attempts[id(conn)] = 0
+				if self._reconnect(conn):
+					delays[id(conn)] = self.reconnect_delay_min
+				else:
+					delays[id(conn)] = min(delays[id(conn)]*2, self.reconnect_delay_max)
+
+	# Check whether the socket to TWS/Gateway is up
+	def _socket_connected(self, conn):
+		try:
+			return conn.isConnected()
+		except:
+			return False
+
+	# Client id of a connection in the pool
+	def _client_id_of(self, conn):
+		return self.client_id + self.conn_pool.index(conn)
 
-	# Called from the tick handler when corresponding message received
+	# Reconnect to TWS/Gateway and replay requests that were in flight on the connection when it dropped
+	# The order id is re-synced when the master reconnects.  Returns True if the connection was re-established
+	def _reconnect(self, conn):
+		try:
+			conn.disconnect()
+		except:
+			pass
+		try:
+			conn.connect()
+			if not self._socket_connected(conn):
+				return False
+		except:
+			logging.exception('Reconnect attempt failed.')
+			return False
+		logging.info('Reconnected client id %d to TWS/Gateway.', self._client_id_of(conn))
+		if conn is self.conn:
+			self.connected = True
+			if not self._set_order_id():
+				logging.error('Reconnected, but no valid order id was received.')
+			# catch up on fills while the connection was down
+			self._request_executions()
+			if self.account_subscribed:
+				self._subscribe_account()
+		self._replay_requests(conn)
+		return True
+
+	# Resend every request in flight, including all active market data subscriptions
+	# If conn is given, only requests sent on that connection are replayed
+	# If held_only is set, only requests that were recorded but never sent go out
+	def _replay_requests(self, conn=None, held_only=False):
+		for key, request in list(self.inflight.items()):
+			if conn is not None and request['conn'] is not conn:
+				continue
+			if held_only and request['sent']:
+				continue
+			logging.debug('Replaying request %s', str(key))
+			self._pace(request['conn'])
+			request['sent'] = True
+			request['send']()
+
+	# Send a request and remember it as in flight until _end_request is called with the same key
+	# conn is the connection the request goes out on, the master by default
+	# If the connection is down, the request is only recorded, and goes out when the connection is back
+	def _send_request(self, key, send, conn=None):
+		if conn is None:
+			conn = self.conn
+		request = self.inflight[key] = {'send': send, 'conn': conn, 'time': time.time(), 'sent': False}
+		if self._socket_connected(conn) and (conn is not self.conn or self.connected):
+			self._pace(conn)
+			request['sent'] = True
+			send()
+
+	# Forget a request once it has been answered or cancelled
+	def _end_request(self, key):
+		self.inflight.pop(key, None)
+
+	# List of (key, client id, age in seconds) for every request in flight, oldest first.  For diagnostics
+	def get_inflight_requests(self):
+		now = time.time()
+		requests = [(key, self._client_id_of(request['conn']), now - request['time']) for key, request in list(self.inflight.items())]
+		return sorted(requests, key=lambda request: -request[2])
+
+	# Called from the tick handler when corresponding message received, with the quote being collected for the tick id
 	# Callbacks assigned in __init__
-	def _set_bid(self, msg):
-		self.bid = msg.price
-	def _set_ask(self, msg):
-		self.ask = msg.price
-	def _set_open(self, msg):
-		self.open = msg.price
-	def _set_last(self, msg):
-		self.last = msg.price
-	def _set_close(self, msg):
-		self.close = msg.price
-	def _set_volume(self, msg):
-		self.volume = msg.size
-	def _set_implied_vol(self, msg):
-		self.implied_vol = msg.size
-	def _set_open_interest(self, msg):
-		self.open_interest = msg.size
+	def _set_bid(self, quote, msg):
+		self._set_field(quote, 'bid', msg.price)
+	def _set_ask(self, quote, msg):
+		self._set_field(quote, 'ask', msg.price)
+	def _set_open(self, quote, msg):
+		self._set_field(quote, 'open', msg.price)
+	def _set_last(self, quote, msg):
+		self._set_field(quote, 'last', msg.price)
+	def _set_close(self, quote, msg):
+		self._set_field(quote, 'close', msg.price)
+	def _set_volume(self, quote, msg):
+		self._set_field(quote, 'volume', msg.size)
+	def _set_implied_vol(self, quote, msg):
+		self._set_field(quote, 'implied_vol', msg.size)
+	def _set_open_interest(self, quote, msg):
+		self._set_field(quote, 'open_interest', msg.size)
+
+	# Set a quote field and record when it was updated.  Every update publishes a new version of the quote's fields
+	def _set_field(self, quote, field, value):
+		quote['fields'].set(field, (value, time.time()))
+
+	# New quote being collected, complete once the fields in the ready groups have arrived
+	def _new_quote(self, ready):
+		return {'fields': DictSnapshot(), 'ready': ready, 'event': Event()}
+
+	# Check if a quote has a field from every one of the ready groups
+	def _quote_ready(self, quote, ready):
+		values = quote['fields'].value()
+		return all(any(field in values for field in group) for group in ready)
+
+	# Read the given fields of a quote, and the update times of all its fields, from one version of the quote
+	def _read_quote(self, quote, fields):
+		values = quote['fields'].value()
+		quote_dict = dict((field, values[field][0] if field in values else None) for field in fields)
+		return quote_dict, dict((field, updated) for field, (value, updated) in values.items())
+
+	# Connection that carries market data and contract details for the given ticker
+	def _data_conn(self, ticker):
+		return self.conn_pool[zlib.crc32(ticker.encode()) % len(self.conn_pool)]
+
+	# Get a fresh tick id or detail id.  Safe to call from several threads
+	# Tick ids still held by a subscription are skipped when the counter wraps around
+	def _next_tick_id(self):
+		with self.id_lock:
+			tick_id = self.tick_id
+			while tick_id in self.quote_requests:
+				tick_id = tick_id % self.id_max + 1
+			self.tick_id = tick_id % self.id_max + 1
+		return tick_id
+	def _next_detail_id(self):
+		with self.id_lock:
+			detail_id = self.detail_id
+			self.detail_id = self.detail_id % self.id_max + 1
+		return detail_id
 
 	# Construct option contract from given data
 	def _make_option_contract(self, ticker, exp, right, strike):
@@ -242,10 +609,15 @@ class IbInterface:
 		return cont
 
 	# Construct a partial contract, in order to get available contracts for given ticker from TWS/Gateway
-	def _make_partial_option_contract(self, ticker):
+	# month (an int like 201711) and right narrow the request to one expiry month and right.  None matches all of them
+	def _make_partial_option_contract(self, ticker, month=None, right=None):
 		cont = Contract()
 		cont.m_symbol = ticker
 		cont.m_secType = 'OPT'
+		if month is not None:
+			cont.m_expiry = str(month)
+		if right is not None:
+			cont.m_right = right
 		cont.m_exchange = 'SMART'
 		cont.m_currency = 'USD'
 		return cont
@@ -259,51 +631,163 @@ class IbInterface:
 		cont.m_currency = 'USD'
 		return cont
 
-	# waits for all fields of a stock quote to be filled
-	def _wait_for_stock_quote(self):
-		# set timeout
+	# waits until every quote in tick_ids has the fields in the ready groups, or until the timeout
+	# The tick handler sets each quote's event as soon as it is complete, so this returns when the last needed field arrives
+	def _wait_for_quotes(self, tick_ids, ready):
 		timeout = time.time() + self.quote_timeout
-		# not thrilled with this way of waiting, but can't think of an alternative for now
-		while(self.tick_cnt < self.stk_tick_max):
-			time.sleep(.1)
-			if time.time() > timeout:
-				break
+		for tick_id in tick_ids:
+			quote = self.quote_requests[tick_id]
+			if quote['ready'] != ready:
+				# streamed quotes were subscribed with their own groups.  Switch to these before checking, so a
+				# tick arriving in between still sets the event
+				quote['ready'] = ready
+				quote['event'].clear()
+			if self._quote_ready(quote, ready):
+				continue
+			if not quote['event'].wait(max(0, timeout - time.time())):
+				logging.debug('Quote %d timed out without all of %s', tick_id, str(ready))
+
+	# Request quotes for a batch of contracts at once, each on the connection for its ticker
+	# requests is a list of (key, contract) tuples.  Returns a dict of quote dicts with the given fields, keyed by key
+	def _request_quotes(self, requests, fields, ready):
+		quotes = {}
+		chunk_size = max(1, self.mkt_data_lines - len(self.subscriptions))
+		for start in range(0, len(requests), chunk_size):
+			tick_ids = {}
+			for key, cont in requests[start:start + chunk_size]:
+				tick_id = self._next_tick_id()
+				conn = self._data_conn(cont.m_symbol)
+				self.quote_requests[tick_id] = self._new_quote(ready)
+				self._send_request(('mkt', tick_id), functools.partial(conn.reqMktData, tick_id, cont, '', False), conn)
+				tick_ids[key] = tick_id
+
+			# wait for data fields to be populated by msg handlers, then cancel the requests
+			self._wait_for_quotes(tick_ids.values(), ready)
+			for key, tick_id in tick_ids.items():
+				self._cancel_mkt_data(tick_id)
+				quote = self.quote_requests.pop(tick_id)
+				quotes[key], self.quote_times[key] = self._read_quote(quote, fields)
+		return quotes
+
+	# Request contract details for a batch of chain parts at once, each on the connection for its ticker
+	# part_list is a list of (ticker, month, right, strike_min, strike_max) tuples.  Answered parts are merged into the
+	# chain cache.  Parts whose request times out keep their old cached contracts, if any
+	def _get_contract_details(self, part_list):
+		detail_ids = {}
+		for ticker, month, right, strike_min, strike_max in part_list:
+			cont = self._make_partial_option_contract(ticker, month, right)
+			conn = self._data_conn(ticker)
+			logging.debug('Requesting details on %s %s %s', ticker, month, right, extra={'ticker': ticker})
+			detail_id = self._next_detail_id()
+			self.detail_requests[detail_id] = {'ticker': ticker, 'month': month, 'right': right, 'strike_min': strike_min,
+												'strike_max': strike_max, 'chain': OptionChain(ticker), 'ready': False}
+			self._send_request(('details', detail_id), functools.partial(self._send_detail_request, conn, detail_id, cont), conn)
+			detail_ids[(ticker, month, right)] = detail_id
 
-	# waits for all fields of an option quote to be filled
-	def _wait_for_option_quote(self):
-		# set timeout
-		timeout = time.time() + self.quote_timeout
-		# not thrilled with this way of waiting, but can't think of an alternative for now
-		while(self.tick_cnt < self.opt_tick_max):
-			# or self.implied_vol is None or self.open_interest is None):
-			time.sleep(.1)
-			if time.time() > timeout:
-				break
-
-	# Get all contracts available for given ticker
-	def _get_contract_details(self, ticker):
-		cont = self._make_partial_option_contract(ticker)
-		logging.debug('Requesting details on ' + ticker)
-		self.conn.reqContractDetails(self.detail_id, cont)
 		logging.debug('Starting timeout timer for contract details')
-		timeout = time.time() + 90
-		while not self.detail_ready:
+		timeout = time.time() + self.detail_timeout
+		while not all(self.detail_requests[detail_id]['ready'] for detail_id in detail_ids.values()):
 			time.sleep(.1)
 			if time.time() > timeout:
 				break
 		logging.debug('Exiting contract details wait')
-		self.detail_ready = False
-		self.list_ticker = ticker
-		self.detail_id = self.detail_id % self.id_max + 1
 
-	# Get the next valid order id
+		for (ticker, month, right), detail_id in detail_ids.items():
+			self._end_request(('details', detail_id))
+			request = self.detail_requests.pop(detail_id)
+			# Only replace the cached part if the request was answered
+			failures = self.chain_failures.setdefault(ticker, {})
+			if request['ready']:
+				chain = self.chain_cache.setdefault(ticker, OptionChain(ticker))
+				chain.remove_part(month, right)
+				chain.merge(request['chain'])
+				self.chain_parts.setdefault(ticker, {})[(month, right)] = (time.time(), request['strike_min'], request['strike_max'])
+				failures.pop((month, right), None)
+				continue
+			# back off before asking for the part again, and serve what is cached until then
+			delay = self.chain_retry_min
+			if (month, right) in failures:
+				delay = min(failures[(month, right)][1]*2, self.chain_retry_max)
+			failures[(month, right)] = (time.time() + delay, delay)
+			if (month, right) in self.chain_parts.get(ticker, {}):
+				logging.warning('Contract details timed out.  Using cached contracts for %s %s %s for %d seconds', ticker, month, right, delay)
+			else:
+				logging.error('Contract details timed out for %s %s %s.  Retrying in %d seconds', ticker, month, right, delay)
+
+	# Clear the collected contracts and request contract details.  Replays start over from an empty chain too
+	def _send_detail_request(self, conn, detail_id, cont):
+		request = self.detail_requests[detail_id]
+		request['chain'] = OptionChain(request['ticker'])
+		conn.reqContractDetails(detail_id, cont)
+
+	# Get the chain for ticker, using the cache unless it is stale
+	def _load_chain(self, ticker):
+		self.load_chains([ticker])
+		return self.chain_cache.get(ticker, OptionChain(ticker))
+
+	# Get the next valid order id.  Returns False if no id arrived before the timeout
+	# The request and the wait hold order_id_lock, so the reconnect on the monitor thread can't race a placement
 	def _set_order_id(self):
-		# request id and wait for it to be populated
-		self.conn.reqIds(1)
-		while not self.id_ready:
-			time.sleep(.1)
-		# reset the id_ready flag
-		self.id_ready = False
+		with self.order_id_lock:
+			# request id and wait for it to be populated
+			self.conn.reqIds(1)
+			timeout = time.time() + self.request_timeout
+			while not self.id_ready:
+				time.sleep(.1)
+				if time.time() > timeout:
+					logging.error('Order id request timed out.')
+					return False
+			# reset the id_ready flag
+			self.id_ready = False
+			return True
+
+	# Reserve a block of consecutive order ids with a single id request.  Returns the first id of the block
+	# TWS accepts any id above the last one used, so ids after the first are assigned locally.
+	# The stored id is advanced to the end of the block so the next valid id message is recognized as fresh
+	# Callers hold order_id_lock until the orders using the block are sent
+	def _reserve_order_ids(self, count):
+		if not self._set_order_id():
+			return None
+		first_id = self.order_id
+		self.order_id = first_id + count - 1
+		return first_id
+
+	# Block until sending another message on conn keeps us under the IB pacing limit.  Defaults to the master connection
+	def _pace(self, conn=None):
+		if conn is None:
+			conn = self.conn
+		with self.pace_locks[id(conn)]:
+			msg_times = self.msg_times[id(conn)]
+			while True:
+				now = time.time()
+				while msg_times and now - msg_times[0] >= 1:
+					msg_times.popleft()
+				if len(msg_times) < self.msg_rate_max:
+					break
+				time.sleep(1 - (now - msg_times[0]))
+			msg_times.append(now)
+
+	# Wait until every order in id_list has a pushed status accepted by done_check, or an order error
+	# Returns a list of the ids that did not get there before the timeout
+	def _wait_for_order_status(self, id_list, done_check, timeout):
+		timeout = time.time() + timeout
+		with self.order_cond:
+			while True:
+				pending = [oid for oid in id_list if oid not in self.order_error_dict and not done_check(self.order_statuses.value().get(oid))]
+				remaining = timeout - time.time()
+				if not pending or remaining <= 0:
+					return pending
+				self.order_cond.wait(remaining)
+
+	# Check the action and right of an order.  Returns False and logs an error if either is unrecognized
+	def _check_order_args(self, action, right):
+		if action != 'BUY' and action != 'SELL':
+			logging.error('Unrecognized action %s. Action must be BUY or SELL. Returning None', str(action))
+			return False
+		if right != 'P' and right != 'C':
+			logging.error('Unrecognized right %s. Right must be P or C. Returning None', str(right))
+			return False
+		return True
 
 	# Make an order to submit to TWS
 	# For now automatically give everything Time-in-force of the day.  No reason to do good-til-cancel from an algo really.
@@ -314,7 +798,7 @@ class IbInterface:
 		order.m_lmtPrice = price
 		order.m_totalQuantity = quantity
 		order.m_orderId = self.order_id
-		order.m_clientId = 0
+		order.m_clientId = self.client_id
 		order.m_permid = 0
 		order.m_auxPrice = 0
 		order.m_tif = 'DAY'
@@ -324,107 +808,212 @@ class IbInterface:
 
 	# EXPOSED METHODS
 	# returns account value as a float
+	# If the request times out or we are disconnected, the last known value is returned
 	def get_account_value(self):
-		self.conn.reqAccountUpdates(1, '')
+		if not self.connected:
+			logging.warning('Not connected.  Returning last known account value.')
+			return self.last_account_value
+		self._subscribe_account()
+		timeout = time.time() + self.request_timeout
 		while(self.account_value is None):
 			time.sleep(.1)
+			if time.time() > timeout:
+				logging.error('Account value request timed out.  Returning last known value.')
+				return self.last_account_value
 		acct_val = self.account_value
+		self.last_account_value = acct_val
 		self._reset_account_data()
 		return acct_val
 
+	# Start the account update subscription.  Requesting it again while it is open makes TWS/Gateway send the whole
+	# account right away, which is how get_account_value gets a fresh value
+	def _subscribe_account(self):
+		self.account_subscribed = True
+		self._pace()
+		self.conn.reqAccountUpdates(1, '')
+
 	# returns a dict of stock quote data
+	# While disconnected, the last quote received for the ticker is returned
 	def get_stock_quote(self, ticker):
-		# create contract for mkt data request, and send request
-		cont = self._make_stock_contract(ticker)
-		self.tick_cnt = 0
-		self.conn.reqMktData(self.tick_id, cont, '', False)
-
-		# wait for data fields to be populated by msg handlers
-		self._wait_for_stock_quote()
-		quote_dict = {
-					'bid' : self.bid,
-					'ask' : self.ask,
-					'last' : self.last,
-					'volume' : self.volume,
-					'close' : self.close
-		}
-
-		# Cancel current mkt data request and increment tick id
-		self.conn.cancelMktData(self.tick_id)
-		self.tick_id = self.tick_id % self.id_max + 1
-
-		# reset tick data fields to None, and return quote
-		self._reset_tick_data()
-		self.tick_cnt = 0
-
+		return self.get_stock_quotes([ticker])[ticker]
+
+	# returns a dict of stock quote dicts keyed by ticker
+	# Subscribed tickers are read from their stream.  All other quotes are requested at once, spread across the
+	# connection pool, so a batch costs about one quote latency
+	# ready is the field groups each quote needs before it is returned, see QUOTE_PRICING and QUOTE_REFERENCE
+	def get_stock_quotes(self, ticker_list, ready=STOCK_QUOTE_READY):
+		streamed = [ticker for ticker in ticker_list if ticker in self.subscriptions]
+		self._wait_for_quotes([self.subscriptions[ticker] for ticker in streamed], ready)
+		quotes = {}
+		for ticker in streamed:
+			quote = self.quote_requests[self.subscriptions[ticker]]
+			quotes[ticker], self.quote_times[ticker] = self._read_quote(quote, STOCK_QUOTE_FIELDS)
+		requests = [(ticker, self._make_stock_contract(ticker)) for ticker in ticker_list
+					if ticker not in self.subscriptions and (self.connected or ticker not in self.quote_cache)]
+		quotes.update(self._request_quotes(requests, STOCK_QUOTE_FIELDS, ready))
+		return dict((ticker, self._check_quote(ticker, quotes.get(ticker))) for ticker in ticker_list)
+
+	# Start streaming quotes for the given tickers.  Subscriptions are replayed after a reconnect
+	# Tickers that don't fit in the available market data lines keep being quoted by snapshot
+	def subscribe_stock_quotes(self, ticker_list):
+		for ticker in ticker_list:
+			if ticker in self.subscriptions:
+				continue
+			if len(self.subscriptions) >= self.mkt_data_lines - self.snapshot_lines:
+				logging.warning('Out of market data lines.  %s will be quoted by snapshot.', ticker)
+				continue
+			cont = self._make_stock_contract(ticker)
+			conn = self._data_conn(ticker)
+			tick_id = self._next_tick_id()
+			self.quote_requests[tick_id] = self._new_quote(STOCK_QUOTE_READY)
+			self.subscriptions[ticker] = tick_id
+			self._send_request(('mkt', tick_id), functools.partial(conn.reqMktData, tick_id, cont, '', False), conn)
+
+	# Stop streaming quotes for the given tickers
+	def unsubscribe_stock_quotes(self, ticker_list):
+		for ticker in ticker_list:
+			tick_id = self.subscriptions.pop(ticker, None)
+			if tick_id is None:
+				continue
+			self._cancel_mkt_data(tick_id)
+			self.quote_requests.pop(tick_id, None)
+
+	# returns a dict of option quote data.  ready is the field groups the quote needs before it is returned
+	def get_option_quote(self, ticker, date, right, strike, ready=OPTION_QUOTE_READY):
+		logging.debug('Received quote request for %s %s %s %s', ticker, date, right, strike, extra={'ticker': ticker})
+		quote_key = (ticker, date, right, strike)
+		quote_dict = None
+		if self.connected or quote_key not in self.quote_cache:
+			# create option contract for data request, and send request
+			cont = self._make_option_contract(ticker, date, right, strike)
+			quote_dict = self._request_quotes([(quote_key, cont)], OPTION_QUOTE_FIELDS, ready)[quote_key]
+		return self._check_quote(quote_key, quote_dict)
+
+	# Seconds since each field of the last quote for quote_key was updated, a ticker or an option quote key like
+	# (ticker, expiry, right, strike).  Fields never received are left out
+	def get_quote_ages(self, quote_key):
+		now = time.time()
+		return dict((field, now - updated) for field, updated in self.quote_times.get(quote_key, {}).items())
+
+	# Cache a freshly received quote, or fall back to the cached quote for quote_key if there is no fresh data
+	def _check_quote(self, quote_key, quote_dict):
+		if quote_dict is None:
+			logging.warning('Not connected.  Returning cached quote for %s', str(quote_key))
+			return dict(self.quote_cache[quote_key])
 		# if all fields are None, log an error
 		# for now don't change return value.  later possible return None in this case, not sure
 		if all(value == None for value in quote_dict.values()):
-			logging.error('No option data found. Could be a problem with data servers.')
-
-		return quote_dict
-
-	# returns a dict of option quote data
-	def get_option_quote(self, ticker, date, right, strike):
-		logging.debug('Received quote request with the following data: ' + str(locals()))
-		# create option contract for data request, and send request
-		cont = self._make_option_contract(ticker, date, right, strike)
-		self.tick_cnt = 0
-		self.conn.reqMktData(self.tick_id, cont, '', False)
-
-		# wait for data fields to be populated by msg handlers
-		self._wait_for_option_quote()
-		quote_dict = {
-					'bid' : self.bid,
-					'ask' : self.ask,
-					'last' : self.last,
-					'close' : self.close,
-					'open' : self.open,
-					'volume' : self.volume,
-		}
-
-		# Cancel current mkt data request and increment tick id
-		self.conn.cancelMktData(self.tick_id)
-		self.tick_id = self.tick_id % self.id_max + 1
-
-		# reset tick data fields to None, and return quote
-		self._reset_tick_data()
-		self.tick_cnt = 0
-
-		# if all fields are None, log an error
-		# for now don't change return value.  later possible return None in this case, not sure
-		if all(value == None for value in quote_dict.values()):
-			logging.error('No option data found. Could be a problem with data servers.')
-
-		return quote_dict
+			logging.error('No quote data found for %s. Could be a problem with data servers.', str(quote_key))
+			return dict(self.quote_cache.get(quote_key, quote_dict))
+		self.quote_cache[quote_key] = quote_dict
+		return dict(quote_dict)
+
+	# Cancel a market data subscription and stop tracking it
+	def _cancel_mkt_data(self, tick_id):
+		request = self.inflight.pop(('mkt', tick_id), None)
+		if request is not None and self._socket_connected(request['conn']):
+			self._pace(request['conn'])
+			request['conn'].cancelMktData(tick_id)
+
+	# Expiry months, as ints like 201711, from today to max_days away.  [None] when max_days is None, for the whole chain
+	def _chain_months(self, max_days):
+		if max_days is None:
+			return [None]
+		day = datetime.date.today()
+		last = day + datetime.timedelta(days=max_days)
+		months = []
+		while day <= last:
+			months.append(day.year*100 + day.month)
+			day = (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+		return months
+
+	# Stock price used to center the strike band of ticker: the given spot, else the last cached quote
+	def _chain_spot(self, ticker, spot_dict):
+		if spot_dict is not None and spot_dict.get(ticker) is not None:
+			return spot_dict[ticker]
+		quote = self.quote_cache.get(ticker, {})
+		if quote.get('last') is not None:
+			return quote['last']
+		return quote.get('close')
+
+	# Check whether a cached part can still be used.  A band part is refetched once the price has moved more than half
+	# the band away from the price it was fetched around, so small moves don't cause a new request.  Without a price
+	# there is nothing to compare against, so the band part is kept
+	def _part_is_fresh(self, part, now, spot):
+		if part is None or now - part[0] >= self.chain_max_age:
+			return False
+		if part[1] is None or spot is None:
+			return True
+		half_band = spot*self.chain_strike_band/2
+		return part[1] <= spot - half_band and spot + half_band <= part[2]
+
+	# Get chains for a batch of tickers at once, spread across the connection pool
+	# Only the parts of each chain within chain_max_days and chain_strike_band are requested, one request per expiry
+	# month and right.  spot_dict optionally gives the stock price for the strike band, keyed by ticker
+	# Cached parts are used unless they are stale.  While disconnected, cached chains are always used
+	def load_chains(self, ticker_list, spot_dict=None):
+		if not self.connected:
+			missing = [ticker for ticker in ticker_list if ticker not in self.chain_cache]
+			if missing:
+				logging.warning('Not connected.  No cached contracts for %s', str(missing))
+			return
+		now = time.time()
+		months = self._chain_months(self.chain_max_days)
+		part_list = []
+		for ticker in ticker_list:
+			spot = None
+			if self.chain_strike_band is not None:
+				spot = self._chain_spot(ticker, spot_dict)
+			parts = self.chain_parts.get(ticker, {})
+			failures = self.chain_failures.get(ticker, {})
+			for month in months:
+				for right in self.chain_rights:
+					if self._part_is_fresh(parts.get((month, right)), now, spot):
+						continue
+					if (month, right) in failures and now < failures[(month, right)][0]:
+						continue
+					if spot is None:
+						part_list.append((ticker, month, right, None, None))
+					else:
+						band = spot*self.chain_strike_band
+						part_list.append((ticker, month, right, spot - band, spot + band))
+		if not part_list:
+			return
+		self._get_contract_details(part_list)
+		# Expired contracts are never refetched, so clear them out of the refreshed chains along with their parts
+		today = datetime.date.today()
+		for ticker in set(part[0] for part in part_list):
+			if ticker in self.chain_cache:
+				self.chain_cache[ticker].remove_expired(today)
+			for parts in (self.chain_parts.get(ticker, {}), self.chain_failures.get(ticker, {})):
+				for month, right in list(parts):
+					if month is not None and month < today.year*100 + today.month:
+						del parts[(month, right)]
 
 	# Returns possible expiries for given ticker
 	# Dates will be returned in string format, wasn't certain whether to use date or str
 	# Decided on date since user-end operations will likely be on date objects, and returning dates improves encapsulation
 	# (Be careful not to spell get_expires by accident)
-	def get_expiries(self, ticker):
+	# load=False reads the cache only, for callers that have just loaded the chain themselves
+	def get_expiries(self, ticker, load=True):
 		# If the ticker is not already stored, then we need to get contracts again
 		# Otherwise the cached contracts apply to this ticker, and we need not get new data
-		if ticker != self.list_ticker:
-			self._get_contract_details(ticker)
-		# Extract unique dates from the contract details list (crazy pythonic method)
-		return list(set([datetime.datetime.strptime(c.m_expiry, "%Y%m%d").date() for c in self.contract_list]))
+		if not load:
+			return self.chain_cache.get(ticker, OptionChain(ticker)).expiry_dates()
+		return self._load_chain(ticker).expiry_dates()
 
 	# Return strikes available for given expiry.  Expiry input must be date for consistency with get_expiries method
-	def get_strikes(self, ticker, expiry):
-		# Convert the date input to a string.  Error if wrong type
-		if type(expiry) is datetime.date:
-			exp_str = expiry.strftime('%Y%m%d')
-		else:
-			logging.error('In get_strikes: Unrecognized expiry type %s, returning None.', str(e_type))
+	def get_strikes(self, ticker, expiry, load=True):
+		# Error if wrong type
+		if type(expiry) is not datetime.date:
+			logging.error('In get_strikes: Unrecognized expiry type %s, returning None.', str(type(expiry)))
 			return None
 
 		# If the ticker is not already stored, then we need to get contracts again
 		# Otherwise the cached contracts apply to this ticker, and we need not get new data
-		if ticker != self.list_ticker:
-			self._get_contract_details(ticker)
-		# Extract strikes for which the contract expiry matches the given (crazy pythonic method)
-		return list(set([c.m_strike for c in self.contract_list if c.m_expiry == exp_str]))
+		if not load:
+			return self.chain_cache.get(ticker, OptionChain(ticker)).strikes_for(expiry)
+		return self._load_chain(ticker).strikes_for(expiry)
 
 	# Place limit order for options contract
 	# Recommend using keyword argument entry for this method, there are many inputs
@@ -432,60 +1021,158 @@ class IbInterface:
 	# If no order id is supplied, the interface automatically gets the next valid order id to use
 	# Supplying an order_id manually is not recommended.  If you'd like to modify an existing order, you should use the modify_option_order command
 	def place_option_order(self, action, ticker, expiry, right, strike, price, quantity, order_id=None):
-		logging.debug('Received order request with the following data: ' + str(locals()))
+		logging.debug('Received order request to %s %s %s %s %s at %s for %s', action, quantity, ticker, expiry, right, strike, price, extra={'ticker': ticker, 'order_id': order_id})
 		# Check args
-		if action != 'BUY' and action != 'SELL':
-			logging.error('Unrecognized action %s. Action must be BUY or SELL. Returning None', str(action))
+		if not self._check_order_args(action, right):
 			return None
-		if right != 'P' and right != 'C':
-			logging.error('Unrecognized right %s. Right must be P or C. Returning None', str(right))
+
+		if not self.connected:
+			logging.error('Not connected.  Order on %s not placed. Returning None', ticker)
 			return None
 
-		# get valid order id
-		if order_id is None:
-			self._set_order_id()
-			order_id = self.order_id
+		# the id is taken and the order sent under the lock, so no other thread gets the same id
+		with self.order_id_lock:
+			# get valid order id
+			if order_id is None:
+				if not self._set_order_id():
+					return None
+				order_id = self.order_id
 
-		# Compile arguments into dict for order storage
-		order_dict = dict(locals())
-		del order_dict['self']
-		order_dict['order_id'] = order_id
+			# Compile arguments into dict for order storage
+			order_dict = dict(locals())
+			del order_dict['self']
+			order_dict['order_id'] = order_id
 
-		# first make the contract and the order
-		order = self._make_order(action, price, quantity)
-		cont = self._make_option_contract(ticker, expiry, right, strike)
-		self.conn.placeOrder(order_id, cont, order)
+			# first make the contract and the order
+			order = self._make_order(action, price, quantity)
+			cont = self._make_option_contract(ticker, expiry, right, strike)
+			self.conn.placeOrder(order_id, cont, order)
 
 		# return order_id as a handle to this order, and increment current order id
 		return order_id
 
+	# Place a batch of limit orders for options contracts
+	# order_list is a list of dicts keyed like the place_option_order arguments. Entries with an order_id modify that order
+	# An optional order_ref key is attached to the order, and comes back with it from get_open_orders
+	# All new order ids are reserved with one request, every order is sent through the pacing limit, and then the whole
+	# batch is confirmed together from pushed status messages, so a batch costs about one confirmation latency
+	# Returns a list of order ids in the same order as order_list, with None for entries that were rejected
+	def place_orders(self, order_list, timeout=None):
+		if timeout is None:
+			timeout = self.confirm_timeout
+		if not self.connected:
+			logging.error('Not connected.  Batch of %d orders not placed.', len(order_list))
+			return [None for o in order_list]
+		valid_flags = [self._check_order_args(o['action'], o['right']) for o in order_list]
+		new_cnt = len([o for o, valid in zip(order_list, valid_flags) if valid and o.get('order_id') is None])
+		# ids are reserved and used under the lock, so batches from several strategies don't share ids
+		with self.order_id_lock:
+			if new_cnt > 0:
+				next_id = self._reserve_order_ids(new_cnt)
+				if next_id is None:
+					valid_flags = [valid and o.get('order_id') is not None for o, valid in zip(order_list, valid_flags)]
+
+			id_list = []
+			sent_list = []
+			for order_dict, valid in zip(order_list, valid_flags):
+				if not valid:
+					id_list.append(None)
+					continue
+				order_id = order_dict.get('order_id')
+				if order_id is None:
+					order_id = next_id
+					next_id = next_id + 1
+				# clear any old status so modifications wait for a fresh confirmation
+				with self.order_cond:
+					self.order_statuses.pop(order_id)
+					self.order_error_dict.pop(order_id, None)
+				order = self._make_order(order_dict['action'], order_dict['price'], order_dict['quantity'])
+				order.m_orderId = order_id
+				order.m_orderRef = order_dict.get('order_ref')
+				cont = self._make_option_contract(order_dict['ticker'], order_dict['expiry'], order_dict['right'], order_dict['strike'])
+				self._pace()
+				self.conn.placeOrder(order_id, cont, order)
+				id_list.append(order_id)
+				sent_list.append(order_id)
+
+		unconfirmed = self._wait_for_order_status(sent_list, lambda entry: entry is not None, timeout)
+		if unconfirmed:
+			logging.warning('No status received for orders %s.  They may still be in transit.', str(unconfirmed))
+		for order_id in sent_list:
+			if order_id in self.order_error_dict:
+				logging.error('Order %d was rejected with error %d', order_id, self.order_error_dict[order_id], extra={'order_id': order_id})
+		return id_list
+
 	# Get order status of order with id order_id
 	# Returns a two item list with a string status and int order_quantity
+	# The open order request makes TWS/Gateway push a fresh status for every working order before the end message
 	def get_order_status(self, order_id):
-		# reset order status, and search for order with id order_id
-		self.order_status = None
-		self.search_id = order_id
-		time.sleep(1)
-		self.conn.reqOpenOrders()
-		timeout = time.time() + 10
-		while self.order_status is None:
-			time.sleep(.1)
-			if time.time() > timeout:
-				logging.error('Order status timed out.  Order must have been filled or cancelled already')
-				return None, None
-		self.search_id = None
-		return self.order_status, self.filled_quantity
+		self._request_open_orders()
+		entry = self.order_statuses.value().get(order_id)
+		if entry is None:
+			logging.error('No status for order %d.  Order must have been filled or cancelled already', order_id, extra={'order_id': order_id})
+			return None, None
+		return entry['status'], entry['filled']
+
+	# Ask for every execution of the day.  The answers are merged into the fill ledger as they arrive.  Returns an
+	# event set once the end message is in
+	def _request_executions(self):
+		req_id = self._next_detail_id()
+		done = self.execution_requests[req_id] = Event()
+		self._send_request(('executions', req_id), functools.partial(self.conn.reqExecutions, req_id, ExecutionFilter()))
+		return done
+
+	# Load the day's fills with one bulk request, so fills that happened before a start or restart are in the ledger
+	# Returns False if the request timed out
+	def load_executions(self):
+		if not self.connected:
+			logging.warning('Not connected.  Executions not loaded.')
+			return False
+		if not self._request_executions().wait(self.request_timeout):
+			logging.error('Execution request timed out.  Fill ledger may be incomplete.')
+			return False
+		logging.info('Loaded %d fills for today', len(self.fills.day_fills()))
+		return True
+
+	# Fills from the ledger, oldest first.  Filter by order id, or by ticker and trade date.  Without filters, the
+	# fills of today are returned.  No request is sent
+	def get_fills(self, order_id=None, ticker=None, day=None):
+		if order_id is not None:
+			return self.fills.order_fills(order_id)
+		if ticker is not None:
+			return self.fills.ticker_fills(ticker, day)
+		return self.fills.day_fills(day)
+
+	# Quantity filled so far on an order, from the fill ledger.  No request is sent
+	def get_filled_quantity(self, order_id):
+		return self.fills.filled_quantity(order_id)
+
+	# Latest pushed status of every order, keyed by order id, as a read-only dict of {'status', 'filled'} entries
+	# No request is sent, so statuses are only as fresh as the last message TWS/Gateway pushed
+	def get_order_statuses(self):
+		return self.order_statuses.value()
 
 	# Get a list of all current holdings
+	# If the request times out or we are disconnected, the last known positions are returned
 	def get_positions(self):
 		logging.debug('Requesting positions...')
+		if not self.connected:
+			logging.warning('Not connected.  Returning last known positions.')
+			return list(self.last_position_list)
+		version = self.positions.read()[0]
+		self._send_request('positions', self._send_positions_request)
+		current = self.positions.wait_newer(version, self.request_timeout)
+		self._end_request('positions')
+		if current is None:
+			logging.error('Position request timed out.  Returning last known positions.')
+			return list(self.last_position_list)
+		self.last_position_list = [dict(pos) for pos in current[1].values()]
+		return list(self.last_position_list)
+
+	# Drop any partial run of positions before asking for a fresh one
+	def _send_positions_request(self):
+		self.positions.reset()
 		self.conn.reqPositions()
-		while not self.positions_ready:
-			time.sleep(.1)
-		self.positions_ready = False
-		ret_list = self.position_list
-		self.position_list = []
-		return ret_list
 
 	# Get quantity of a single stock position
 	def get_stock_position(self):
@@ -493,43 +1180,70 @@ class IbInterface:
 
 	# Get a list of open order ids
 	def get_open_order_ids(self):
-		self.open_id_list = []
-		self.open_order_ready = False
+		return list(self._request_open_orders().keys())
+
+	# Get a dict of open orders keyed by order id.  Each entry holds the ticker, action, price, quantity, order_ref,
+	# and for options the right, expiry and strike, so working orders can be matched up after a restart
+	def get_open_orders(self):
+		return dict((order_id, dict(order)) for order_id, order in self._request_open_orders().items())
+
+	# Request open orders and wait for the end message.  Returns the published open orders, which are the last
+	# complete list if the request times out
+	def _request_open_orders(self):
+		version = self.open_orders.read()[0]
+		self._send_request('open_orders', self._send_open_orders_request)
+		current = self.open_orders.wait_newer(version, 10)
+		self._end_request('open_orders')
+		if current is None:
+			logging.error('Open order request timed out.  Returning last known open orders')
+			return self.open_orders.value()
+		return current[1]
+
+	# Drop open orders pushed outside a request, e.g. after placing an order, before asking for the full list
+	def _send_open_orders_request(self):
+		self.open_orders.reset()
 		self.conn.reqOpenOrders()
-		timeout = time.time() + 10
-		while not self.open_order_ready:
-			if time.time() > timeout:
-				logging.error('Open order id request timed out.  List may be incomplete')
-				break
-			time.sleep(.1)
-		return list(set(self.open_id_list))
 
 	# Cancel single order with order_id
+	# Returns a cancelled flag and the filled quantity, or None for the quantity if no status was ever received
 	def cancel_order(self, order_id):
-		self.conn.cancelOrder(order_id)
-		timeout = time.time() + 60
-		logging.debug('starting order cancel check')
-		while True:
-			logging.debug('getting order status')
-			status, filled = self.get_order_status(order_id)
-			if status is None:
-				logging.info('Order returned no status.  Must already be filled or cancelled.')
-				return False, None
-			if status == 'cancelled' or status == 'Cancelled':
-				logging.info('Order cancelled successfully.')
-				if filled is not None:
-					logging.info('Filled quantity was %d', filled)
-				return True, filled
-			elif status == 'filled' or status == 'Filled':
-				logging.info('Order was filled before it could be cancelled.')
-				if filled is not None:
-					logging.info('Filled quantity was %d', filled)
-			if time.time() > timeout:
-				logging.info('Order cancel timed out. Order has not been confirmed for cancel.')
-				if filled is not None:
-					logging.info('Filled quantity was %d', filled)
-				return False, filled
-			time.sleep(.1)
+		return self.cancel_orders([order_id], timeout=60)[order_id]
+
+	# Cancel a batch of orders.  Every cancel is sent through the pacing limit, and then the whole batch is confirmed
+	# together from pushed status messages instead of polling each order
+	# Returns a dict keyed by order id with the same (cancelled flag, filled quantity) tuple as cancel_order
+	def cancel_orders(self, id_list, timeout=None):
+		if timeout is None:
+			timeout = self.confirm_timeout
+		if not self.connected:
+			logging.error('Not connected.  Orders %s not cancelled.', str(id_list))
+			return dict((order_id, (False, None)) for order_id in id_list)
+		for order_id in id_list:
+			self._pace()
+			self.conn.cancelOrder(order_id)
+		logging.debug('starting order cancel check for %d orders', len(id_list))
+		self._wait_for_order_status(id_list, lambda entry: entry is not None and entry['status'] in FINAL_STATUSES, timeout)
+
+		statuses = self.order_statuses.value()
+		results = {}
+		for order_id in id_list:
+			entry = statuses.get(order_id)
+			if entry is None:
+				logging.info('Order %d returned no status.  Must already be filled or cancelled.', order_id, extra={'order_id': order_id})
+				results[order_id] = (False, None)
+				continue
+			status = entry['status']
+			filled = entry['filled']
+			if status in CANCELLED_STATUSES:
+				logging.info('Order %d cancelled successfully. Filled quantity was %d', order_id, filled, extra={'order_id': order_id})
+				results[order_id] = (True, filled)
+			elif status in FILLED_STATUSES:
+				logging.info('Order %d was filled before it could be cancelled. Filled quantity was %d', order_id, filled, extra={'order_id': order_id})
+				results[order_id] = (False, filled)
+			else:
+				logging.info('Order %d cancel timed out. Order has not been confirmed for cancel. Filled quantity was %d', order_id, filled, extra={'order_id': order_id})
+				results[order_id] = (False, filled)
+		return results
 
 
 	# Cancel all open orders
@@ -539,10 +1253,19 @@ class IbInterface:
 	# Shut down the interface
 	def shut_down(self):
 		logging.info('Shutting down interface.')
+		self.monitor = False
+		self.disconnect_event.set()
+		self.connected = False
+		for conn in self.conn_pool:
+			try:
+				conn.disconnect()
+			except:
+				pass
 		return None
 
 # test main
 def main():
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 	try:
 		ibif = IbInterface()
 		exp = datetime.date(2017, 12, 1)
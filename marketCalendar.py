@@ -0,0 +1,149 @@
+# NYSE trading calendar, computed locally
+# Regular hours, holidays and early closes are worked out from the exchange's rules for any year, so the bot
+# needs no calendar file or data request to know when the market is open.  Times are in New York time.
+
+# date operations
+import datetime
+# exchange time zone
+from zoneinfo import ZoneInfo
+
+# Exchange time zone and regular session hours
+MARKET_TZ = ZoneInfo('America/New_York')
+OPEN_TIME = datetime.time(9, 30)
+CLOSE_TIME = datetime.time(16, 0)
+EARLY_CLOSE_TIME = datetime.time(13, 0)
+
+# Date of Easter Sunday for the given year (anonymous Gregorian computus)
+def easter(year):
+	a = year % 19
+	b, c = divmod(year, 100)
+	d, e = divmod(b, 4)
+	f = (b + 8) // 25
+	g = (b - f + 1) // 3
+	h = (19*a + b - d - g + 15) % 30
+	i, k = divmod(c, 4)
+	l = (32 + 2*e + 2*i - h - k) % 7
+	m = (a + 11*h + 22*l) // 451
+	month, day = divmod(h + l - 7*m + 114, 31)
+	return datetime.date(year, month, day + 1)
+
+# The nth given weekday (0 is Monday) of a month.  n of -1 gives the last one
+def nth_weekday(year, month, weekday, n):
+	if n > 0:
+		day = datetime.date(year, month, 1)
+		day = day + datetime.timedelta(days=(weekday - day.weekday()) % 7 + 7*(n - 1))
+	else:
+		day = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+		day = day - datetime.timedelta(days=(day.weekday() - weekday) % 7)
+	return day
+
+# Move a fixed date holiday that falls on a weekend to the weekday it is observed on
+def observed(day):
+	if day.weekday() == 5:
+		return day - datetime.timedelta(days=1)
+	if day.weekday() == 6:
+		return day + datetime.timedelta(days=1)
+	return day
+
+# Exchange holidays for the given year, as a dict of names keyed by date
+def market_holidays(year):
+	holidays = {}
+	# New Year's Day on a Saturday is not observed on the Friday before, since that would close the previous year
+	new_year = datetime.date(year, 1, 1)
+	if new_year.weekday() != 5:
+		holidays[observed(new_year)] = "New Year's Day"
+	holidays[nth_weekday(year, 1, 0, 3)] = 'Martin Luther King Jr. Day'
+	holidays[nth_weekday(year, 2, 0, 3)] = "Washington's Birthday"
+	holidays[easter(year) - datetime.timedelta(days=2)] = 'Good Friday'
+	holidays[nth_weekday(year, 5, 0, -1)] = 'Memorial Day'
+	if year >= 2022:
+		holidays[observed(datetime.date(year, 6, 19))] = 'Juneteenth'
+	holidays[observed(datetime.date(year, 7, 4))] = 'Independence Day'
+	holidays[nth_weekday(year, 9, 0, 1)] = 'Labor Day'
+	holidays[nth_weekday(year, 11, 3, 4)] = 'Thanksgiving Day'
+	holidays[observed(datetime.date(year, 12, 25))] = 'Christmas Day'
+	return holidays
+
+# Early close days for the given year, as a dict of close times keyed by date
+# The market closes early on July 3rd, the day after Thanksgiving, and Christmas Eve, when those are trading days
+def early_closes(year):
+	holidays = market_holidays(year)
+	days = [datetime.date(year, 7, 3), nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1), datetime.date(year, 12, 24)]
+	return dict((day, EARLY_CLOSE_TIME) for day in days if day.weekday() < 5 and day not in holidays)
+
+class MarketCalendar:
+	def __init__(self):
+		# holidays and early closes are computed once per year and kept
+		self.holiday_cache = {}
+		self.early_close_cache = {}
+
+	# Current time in the exchange time zone
+	def now(self):
+		return datetime.datetime.now(MARKET_TZ)
+
+	# Holidays for the year, computed on first use
+	def holidays(self, year):
+		if year not in self.holiday_cache:
+			self.holiday_cache[year] = market_holidays(year)
+		return self.holiday_cache[year]
+
+	# Early closes for the year, computed on first use
+	def early_closes(self, year):
+		if year not in self.early_close_cache:
+			self.early_close_cache[year] = early_closes(year)
+		return self.early_close_cache[year]
+
+	# Check if the market trades on the given date
+	def is_trading_day(self, day):
+		return day.weekday() < 5 and day not in self.holidays(day.year)
+
+	# Open and close of the session on the given date, as aware datetimes.  None if the market doesn't trade that day
+	def session(self, day):
+		if not self.is_trading_day(day):
+			return None
+		close_time = self.early_closes(day.year).get(day, CLOSE_TIME)
+		return (datetime.datetime.combine(day, OPEN_TIME, tzinfo=MARKET_TZ),
+				datetime.datetime.combine(day, close_time, tzinfo=MARKET_TZ))
+
+	# Check if the market is open at the given time, now by default
+	def is_open(self, when=None):
+		when = self._to_market_time(when)
+		session = self.session(when.date())
+		return session is not None and session[0] <= when < session[1]
+
+	# The session that is open at the given time, or else the next one to open, as an (open, close) tuple
+	def next_session(self, when=None):
+		when = self._to_market_time(when)
+		day = when.date()
+		while True:
+			session = self.session(day)
+			if session is not None and when < session[1]:
+				return session
+			day = day + datetime.timedelta(days=1)
+
+	# Close of the session that is open at the given time.  None if the market is closed
+	def session_close(self, when=None):
+		when = self._to_market_time(when)
+		if not self.is_open(when):
+			return None
+		return self.session(when.date())[1]
+
+	# Check if weekly options expire on the given date: the last trading day of its week, which is Friday unless
+	# Friday is a holiday
+	def is_expiration_day(self, day):
+		if not self.is_trading_day(day):
+			return False
+		later = day + datetime.timedelta(days=1)
+		while later.weekday() < 5:
+			if self.is_trading_day(later):
+				return False
+			later = later + datetime.timedelta(days=1)
+		return True
+
+	# Convert a time to the exchange time zone.  Naive times are taken to be exchange time already
+	def _to_market_time(self, when):
+		if when is None:
+			return self.now()
+		if when.tzinfo is None:
+			return when.replace(tzinfo=MARKET_TZ)
+		return when.astimezone(MARKET_TZ)
@@ -0,0 +1,124 @@
+# Local HTTP endpoint for watching the bot without reading its logs
+# Strategies publish their state into a snapshot at the end of every pass of their loop, and the server only reads
+# those snapshots, so any number of dashboards can watch at any refresh rate without adding IB requests or touching
+# the trading threads.  Requests are served on threads of their own.
+# GET /state returns the state of every strategy as JSON.  GET /events is a server-sent event stream: a 'state' event
+# with the full state, and then an 'update' event with only what changed each time a strategy publishes.
+
+# state is sent as json
+import json
+# python logging library for monitoring and debugging
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+# Default address.  Only the local machine can connect unless the host is changed
+MONITOR_HOST = '127.0.0.1'
+MONITOR_PORT = 8765
+# Seconds between keep-alive comments on a quiet event stream, so proxies and clients don't drop it
+KEEPALIVE_INTERVAL = 15
+
+# Encode state as compact json.  Dates and anything else json doesn't know are sent as strings
+def to_json(value):
+	return json.dumps(value, default=str, separators=(',', ':'))
+
+# Changes between two versions of the published state, keyed by strategy
+# Sections that are dicts are compared key by key, so a quote update only sends that ticker's quote.  Each strategy
+# with changes gets {'set': {section: value or {key: value}}, 'removed': {section: [keys]}}, and a strategy that
+# stopped publishing maps to None
+def state_diff(old, new):
+	diff = {}
+	for name, state in new.items():
+		old_state = old.get(name, {})
+		changed = {}
+		removed = {}
+		for section, value in state.items():
+			old_value = old_state.get(section)
+			if value == old_value:
+				continue
+			if isinstance(value, dict) and isinstance(old_value, dict):
+				changed[section] = dict((key, item) for key, item in value.items() if old_value.get(key) != item)
+				gone = [key for key in old_value if key not in value]
+				if gone:
+					removed[section] = gone
+			else:
+				changed[section] = value
+		if changed or removed:
+			diff[name] = {'set': changed, 'removed': removed}
+	for name in old:
+		if name not in new:
+			diff[name] = None
+	return diff
+
+class MonitorHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		path = self.path.split('?', 1)[0]
+		if path == '/state':
+			self._send_state()
+		elif path == '/events':
+			self._stream_events()
+		else:
+			self.send_error(404)
+
+	def _send_state(self):
+		body = to_json(dict(self.server.state.value())).encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('Access-Control-Allow-Origin', '*')
+		self.end_headers()
+		self.wfile.write(body)
+
+	# Stream the full state, then the changes of every new version, until the client goes away
+	# Versions published while an update is being sent are folded into the next update
+	def _stream_events(self):
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/event-stream')
+		self.send_header('Cache-Control', 'no-cache')
+		self.send_header('Access-Control-Allow-Origin', '*')
+		self.end_headers()
+		version, state = self.server.state.read()
+		try:
+			self._send_event('state', version, dict(state))
+			while self.server.running:
+				current = self.server.state.wait_newer(version, KEEPALIVE_INTERVAL)
+				if current is None:
+					self.wfile.write(b': keepalive\n\n')
+					self.wfile.flush()
+					continue
+				version, new_state = current
+				self._send_event('update', version, state_diff(state, new_state))
+				state = new_state
+		except (BrokenPipeError, ConnectionResetError):
+			logging.debug('Monitor client %s disconnected', self.client_address[0])
+
+	def _send_event(self, event, version, data):
+		self.wfile.write(('event: %s\nid: %d\ndata: %s\n\n' % (event, version, to_json(data))).encode())
+		self.wfile.flush()
+
+	# Request lines go to the debug log instead of stderr
+	def log_message(self, format, *args):
+		logging.debug('Monitor: ' + format, *args)
+
+# Serves the published state of the strategies on a background thread.  state is the DictSnapshot the strategies
+# publish into, keyed by strategy name
+class MonitorServer:
+	def __init__(self, state, host=MONITOR_HOST, port=MONITOR_PORT):
+		self.server = ThreadingHTTPServer((host, port), MonitorHandler)
+		self.server.daemon_threads = True
+		self.server.state = state
+		self.server.running = True
+		self.thread = Thread(target=self.server.serve_forever, name='MonitorServer')
+		self.thread.daemon = True
+		self.thread.start()
+		logging.info('Monitor listening on http://%s:%d', host, self.server.server_address[1])
+
+	# Port the server is listening on, for when it was started on port 0
+	def port(self):
+		return self.server.server_address[1]
+
+	# Stop serving.  Open event streams end at their next keep-alive
+	def shut_down(self):
+		self.server.running = False
+		self.server.shutdown()
+		self.server.server_close()
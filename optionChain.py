@@ -0,0 +1,159 @@
+# Compact storage for option chains
+# Contract detail messages carry a full Contract object for every option, but the bot only ever needs a handful of
+# fields from them.  OptionChain keeps just those fields in flat typed arrays, filled in as the detail messages arrive,
+# so caching chains for hundreds of tickers takes a few kilobytes each instead of megabytes.
+# Run this file directly for a memory benchmark against keeping the Contract objects.
+
+# typed arrays for the chain columns
+from array import array
+# date operations
+import datetime
+
+# Multiplier used when a contract doesn't specify one
+DEFAULT_MULTIPLIER = 100
+
+# Convert an IB expiry string (YYYYMMDD, sometimes followed by a time) to an int date like 20171124
+def expiry_to_int(expiry):
+	return int(expiry[:8])
+
+# Convert an int date like 20171124 to a date
+def int_to_date(value):
+	return datetime.date(value // 10000, value // 100 % 100, value % 100)
+
+# Convert a date to an int date like 20171124
+def date_to_int(date):
+	return date.year*10000 + date.month*100 + date.day
+
+# Option contracts for a single ticker, one entry per contract across parallel arrays
+# Rights are stored as the bytes P and C
+class OptionChain:
+	def __init__(self, ticker):
+		self.ticker = ticker
+		self.con_ids = array('q')
+		self.expiries = array('i')
+		self.rights = bytearray()
+		self.strikes = array('d')
+		self.multipliers = array('i')
+
+	def __len__(self):
+		return len(self.con_ids)
+
+	# Add a contract from a contract detail message
+	def add_contract(self, cont):
+		self.con_ids.append(cont.m_conId or 0)
+		self.expiries.append(expiry_to_int(cont.m_expiry))
+		self.rights.append(ord(cont.m_right[0]))
+		self.strikes.append(cont.m_strike)
+		if cont.m_multiplier:
+			self.multipliers.append(int(float(cont.m_multiplier)))
+		else:
+			self.multipliers.append(DEFAULT_MULTIPLIER)
+
+	# Add every contract of another chain for the same ticker that isn't already in this one
+	def merge(self, other):
+		known = set(self.con_ids)
+		for i in range(len(other)):
+			if other.con_ids[i] in known and other.con_ids[i] != 0:
+				continue
+			self.con_ids.append(other.con_ids[i])
+			self.expiries.append(other.expiries[i])
+			self.rights.append(other.rights[i])
+			self.strikes.append(other.strikes[i])
+			self.multipliers.append(other.multipliers[i])
+
+	# Keep only the contracts for which keep(index) is true
+	def _filter(self, keep):
+		rows = [i for i in range(len(self)) if keep(i)]
+		self.con_ids = array('q', (self.con_ids[i] for i in rows))
+		self.expiries = array('i', (self.expiries[i] for i in rows))
+		self.rights = bytearray(self.rights[i] for i in rows)
+		self.strikes = array('d', (self.strikes[i] for i in rows))
+		self.multipliers = array('i', (self.multipliers[i] for i in rows))
+
+	# Remove the contracts of one part of the chain, so a fresh copy of the part can be merged in
+	# month is an int like 201711, right is P or C.  None matches every month or right
+	def remove_part(self, month, right):
+		right_byte = None if right is None else ord(right)
+		self._filter(lambda i: not ((month is None or self.expiries[i] // 100 == month)
+									and (right_byte is None or self.rights[i] == right_byte)))
+
+	# Remove contracts that expired before the given date
+	def remove_expired(self, date):
+		exp_int = date_to_int(date)
+		self._filter(lambda i: self.expiries[i] >= exp_int)
+
+	# Unique expiries in the chain, as dates
+	def expiry_dates(self):
+		return [int_to_date(value) for value in set(self.expiries)]
+
+	# Unique strikes for the given expiry date, optionally only for the given right (P or C)
+	def strikes_for(self, expiry, right=None):
+		exp_int = date_to_int(expiry)
+		if right is None:
+			return list(set(strike for strike, exp in zip(self.strikes, self.expiries) if exp == exp_int))
+		right_byte = ord(right)
+		return list(set(strike for strike, exp, r in zip(self.strikes, self.expiries, self.rights) if exp == exp_int and r == right_byte))
+
+	# Contract id of an option, or None if it isn't in the chain
+	def con_id_for(self, expiry, right, strike):
+		exp_int = date_to_int(expiry)
+		right_byte = ord(right)
+		for con_id, exp, r, s in zip(self.con_ids, self.expiries, self.rights, self.strikes):
+			if exp == exp_int and r == right_byte and s == strike:
+				return con_id
+		return None
+
+	# Approximate memory used by the chain, in bytes
+	def nbytes(self):
+		return sum(column.itemsize*len(column) for column in (self.con_ids, self.expiries, self.strikes, self.multipliers)) + len(self.rights)
+
+# Compare the memory taken by caching chains as Contract objects against OptionChain
+def benchmark_memory(ticker_cnt=300, expiry_cnt=8, strike_cnt=60):
+	import tracemalloc
+	from ib.ext.Contract import Contract
+
+	today = datetime.date.today()
+	expiries = [(today + datetime.timedelta(days=7*i)).strftime('%Y%m%d') for i in range(expiry_cnt)]
+
+	# Stream of contracts like the ones in contract detail messages
+	def make_contracts(ticker):
+		con_id = 0
+		for expiry in expiries:
+			for right in 'PC':
+				for k in range(strike_cnt):
+					cont = Contract()
+					con_id = con_id + 1
+					cont.m_conId = con_id
+					cont.m_symbol = ticker
+					cont.m_secType = 'OPT'
+					cont.m_expiry = expiry
+					cont.m_right = right
+					cont.m_strike = 20.0 + .5*k
+					cont.m_multiplier = '100'
+					cont.m_exchange = 'SMART'
+					cont.m_currency = 'USD'
+					yield cont
+
+	tracemalloc.start()
+	start = tracemalloc.take_snapshot()
+	object_cache = dict(('T%d' % i, list(make_contracts('T%d' % i))) for i in range(ticker_cnt))
+	object_bytes = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(start, 'filename'))
+	del object_cache
+
+	start = tracemalloc.take_snapshot()
+	chain_cache = {}
+	for i in range(ticker_cnt):
+		chain = OptionChain('T%d' % i)
+		for cont in make_contracts('T%d' % i):
+			chain.add_contract(cont)
+		chain_cache['T%d' % i] = chain
+	chain_bytes = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(start, 'filename'))
+	tracemalloc.stop()
+
+	contract_cnt = ticker_cnt*expiry_cnt*2*strike_cnt
+	print('%d tickers, %d contracts' % (ticker_cnt, contract_cnt))
+	print('Contract objects: %.1f MB (%d bytes per contract)' % (object_bytes/1e6, object_bytes // contract_cnt))
+	print('OptionChain:      %.1f MB (%d bytes per contract)' % (chain_bytes/1e6, chain_bytes // contract_cnt))
+
+if __name__ == '__main__':
+	benchmark_memory()
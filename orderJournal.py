@@ -0,0 +1,124 @@
+# Crash-safe journal of the orders owned by the OptionSeller
+# Every order intent and state transition is appended to a JSON-lines file and flushed to disk before the bot moves on.
+# On startup the journal is replayed, so a restarted bot knows which working orders are its own.
+# The file is periodically compacted down to one record per live order so replay stays fast.
+
+# used for unique order references
+import time
+# date operations
+import datetime
+# journal records are stored as json lines
+import json
+import os
+# python logging library for monitoring and debugging
+import logging
+
+# Default location of the journal file
+JOURNAL_FILE = 'orders.journal'
+
+# Order fields that are stored in the journal.  Expiry is converted to a string, everything else is json friendly already
+ORDER_KEYS = ('id', 'order_ref', 'ticker', 'action', 'right', 'expiry', 'strike', 'price', 'quantity', 'loop_cnt', 'mod_cnt')
+
+# ref_prefix starts every order reference, so orders can be told apart when several strategies share an account
+class OrderJournal:
+	def __init__(self, path=JOURNAL_FILE, compact_max=500, ref_prefix='ibbot'):
+		self.path = path
+		# number of records appended since the last compaction, and the amount that triggers a compaction
+		self.record_cnt = 0
+		self.compact_max = compact_max
+		# live orders keyed by order reference, as last written to the journal
+		self.orders = {}
+		# prefix and counter for order references.  The prefix is the start time in nanoseconds, so references are unique
+		# across restarts, even a restart within the same second.  load() also moves the counter past any recovered
+		# reference with the same prefix
+		self.ref_prefix = '%s.%d' % (ref_prefix, time.time_ns())
+		self.ref_cnt = 0
+		self.journal_file = None
+
+	# Convert an order dict to a journal record
+	def _encode_order(self, order):
+		rec = {}
+		for key in ORDER_KEYS:
+			if key in order:
+				rec[key] = order[key]
+		if isinstance(rec.get('expiry'), datetime.date):
+			rec['expiry'] = rec['expiry'].strftime('%Y%m%d')
+		return rec
+
+	# Convert a journal record back to an order dict
+	def _decode_order(self, rec):
+		order = dict(rec)
+		if order.get('expiry') is not None:
+			order['expiry'] = datetime.datetime.strptime(order['expiry'], '%Y%m%d').date()
+		return order
+
+	# Append a record and make sure it hits the disk before returning
+	def _append(self, record):
+		if self.journal_file is None:
+			self.journal_file = open(self.path, 'a')
+		self.journal_file.write(json.dumps(record) + '\n')
+		self.journal_file.flush()
+		os.fsync(self.journal_file.fileno())
+		self.record_cnt = self.record_cnt + 1
+		if self.record_cnt >= self.compact_max:
+			self.compact()
+
+	# Replay the journal file and return the live orders as a dict keyed by order reference
+	# A torn final line from a crash mid-write is skipped
+	def load(self):
+		self.orders = {}
+		if not os.path.exists(self.path):
+			return {}
+		with open(self.path, 'r') as journal_file:
+			for line in journal_file:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					logging.warning('Skipping unreadable journal line: %s', line.strip())
+					continue
+				if record['op'] == 'order':
+					self.orders[record['order']['order_ref']] = record['order']
+				elif record['op'] == 'remove':
+					self.orders.pop(record['order_ref'], None)
+		for ref in self.orders:
+			prefix, sep, cnt = ref.rpartition('.')
+			if prefix == self.ref_prefix and cnt.isdigit():
+				self.ref_cnt = max(self.ref_cnt, int(cnt))
+		self.compact()
+		return dict((ref, self._decode_order(rec)) for ref, rec in self.orders.items())
+
+	# Rewrite the journal with one record per live order.  The new file replaces the old one atomically
+	def compact(self):
+		if self.journal_file is not None:
+			self.journal_file.close()
+			self.journal_file = None
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as tmp_file:
+			for rec in self.orders.values():
+				tmp_file.write(json.dumps({'op': 'order', 'order': rec}) + '\n')
+			tmp_file.flush()
+			os.fsync(tmp_file.fileno())
+		os.replace(tmp_path, self.path)
+		self.record_cnt = 0
+
+	# Get a fresh order reference.  Attached to orders so they can be recognized in the open order list after a restart
+	def new_ref(self):
+		self.ref_cnt = self.ref_cnt + 1
+		return '%s.%d' % (self.ref_prefix, self.ref_cnt)
+
+	# Record the current state of an order.  Used for intents (no id yet), placements, and modifications
+	def write_order(self, order):
+		rec = self._encode_order(order)
+		self.orders[rec['order_ref']] = rec
+		self._append({'op': 'order', 'order': rec})
+
+	# Record that an order is no longer working
+	def remove_order(self, order_ref):
+		if self.orders.pop(order_ref, None) is not None:
+			self._append({'op': 'remove', 'order_ref': order_ref})
+
+	# Close the journal file
+	def close(self):
+		if self.journal_file is not None:
+			self.journal_file.close()
+			self.journal_file = None
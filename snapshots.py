@@ -0,0 +1,167 @@
+# Immutable snapshots shared between the threads that produce data, mainly the IB reader thread, and the threads that
+# consume it.  New data is built privately and published as a read-only version with a single reference
+# assignment, which is atomic in Python.  Consumers grab the current version once and work from it, so they never see
+# a half-written quote or position list and never take a lock.  Waiting for a newer version uses a condition, but
+# reading never does.
+# Run this file directly for a stress test that floods the interface with ticks and positions while a strategy reads.
+
+# read-only views of published dicts
+from types import MappingProxyType
+from threading import Condition
+import time
+
+# Empty read-only mapping, the first version of every snapshot
+EMPTY = MappingProxyType({})
+
+# A value published in versions.  read() returns the latest (version, value) pair without locking
+class Snapshot:
+	def __init__(self, value=EMPTY):
+		self.current = (0, value)
+		self.cond = Condition()
+
+	# Latest (version, value) pair
+	def read(self):
+		return self.current
+
+	# Latest value
+	def value(self):
+		return self.current[1]
+
+	# Publish a new value.  Publishing is serialized by the condition's lock, which is reentrant, so subclasses can
+	# build a new value from the current one under the same lock
+	def publish(self, value):
+		with self.cond:
+			self.current = (self.current[0] + 1, value)
+			self.cond.notify_all()
+
+	# Wait until a version newer than version is published.  Returns the latest (version, value), or None on timeout
+	def wait_newer(self, version, timeout):
+		end = time.time() + timeout
+		with self.cond:
+			while self.current[0] <= version:
+				remaining = end - time.time()
+				if remaining <= 0:
+					return None
+				self.cond.wait(remaining)
+			return self.current
+
+# Snapshot of a dict that is updated one key at a time.  Every update publishes a new read-only copy, which is cheap
+# for the few fields of a quote or the statuses of the working orders
+# Several threads may update the same dict, like the strategies publishing their state for the monitor, so the copy
+# is made and published under the lock, and no update is lost
+class DictSnapshot(Snapshot):
+	def set(self, key, value):
+		with self.cond:
+			new = dict(self.current[1])
+			new[key] = value
+			self.publish(MappingProxyType(new))
+
+	def pop(self, key):
+		self.pop_all([key])
+
+	# Remove several keys with a single copy
+	def pop_all(self, keys):
+		with self.cond:
+			keys = [key for key in keys if key in self.current[1]]
+			if keys:
+				new = dict(self.current[1])
+				for key in keys:
+					del new[key]
+				self.publish(MappingProxyType(new))
+
+# Snapshot of a list or dict that arrives as a run of messages followed by an end message, like positions and open
+# orders.  The reader thread fills a private buffer and publishes it as a whole on the end message.  Only the reader
+# thread adds to the buffer
+class BufferedSnapshot(Snapshot):
+	def __init__(self, value=EMPTY):
+		Snapshot.__init__(self, value)
+		self.buffer = {}
+
+	# Add an item to the buffer under key
+	def add(self, key, item):
+		self.buffer[key] = item
+
+	# Publish the buffer and start a new one
+	def end(self):
+		buffer = self.buffer
+		self.buffer = {}
+		self.publish(MappingProxyType(buffer))
+
+	# Drop a partly filled buffer, before asking for a fresh run
+	def reset(self):
+		self.buffer = {}
+
+# Flood the interface's handlers from a writer thread, the way the IB reader thread calls them, while a strategy
+# thread reads quotes and positions through the interface at full speed.  No TWS/Gateway is needed: the connection
+# checks are forced on and reqPositions is answered by the writer.  Every tick of a batch carries the batch number, so
+# a quote whose ask is neither its bid nor the batch before it, or a position list with mixed costs or a wrong count,
+# is a torn read
+def stress_test(duration=3.0, batch_size=50, num_tickers=20):
+	from threading import Thread, Event
+	from types import SimpleNamespace
+	from ibInterface import IbInterface, STOCK_QUOTE_READY, TickTypes
+
+	ib = IbInterface()
+	ib.monitor = False
+	ib.disconnect_event.set()
+	ib.monitor_thread.join()
+	ib._socket_connected = lambda conn: True
+	ib.connected = True
+	tickers = ['T%d' % i for i in range(num_tickers)]
+	for ticker in tickers:
+		tick_id = ib._next_tick_id()
+		ib.quote_requests[tick_id] = ib._new_quote(STOCK_QUOTE_READY)
+		ib.subscriptions[ticker] = tick_id
+	contracts = [ib._make_stock_contract('P%d' % i) for i in range(batch_size)]
+	requested = Event()
+	ib.conn.reqPositions = requested.set
+	stop = [False]
+	results = {}
+
+	def write():
+		batch = 0
+		while not stop[0]:
+			batch = batch + 1
+			for ticker in tickers:
+				tick_id = ib.subscriptions[ticker]
+				for field in (TickTypes.CLOSE, TickTypes.BID, TickTypes.ASK):
+					ib._tick_handler(SimpleNamespace(tickerId=tick_id, field=field, price=float(batch)))
+			if requested.is_set():
+				requested.clear()
+				for i, cont in enumerate(contracts):
+					ib._positions_handler(SimpleNamespace(account='DU1', contract=cont, pos=i, avgCost=float(batch)))
+				ib._positions_end_handler(None)
+
+	def read():
+		quote_reads = quote_torn = position_reads = position_torn = 0
+		last_read = 0
+		while not stop[0]:
+			for quote in ib.get_stock_quotes(tickers).values():
+				if quote['ask'] not in (quote['bid'], quote['bid'] - 1):
+					quote_torn = quote_torn + 1
+				quote_reads = quote_reads + 1
+			# positions are requested at most every 50 ms, so quote reads keep their pace
+			if time.time() - last_read > .05:
+				last_read = time.time()
+				positions = ib.get_positions()
+				if len(set(pos['cost'] for pos in positions)) != 1 or len(positions) != batch_size:
+					position_torn = position_torn + 1
+				position_reads = position_reads + 1
+		results['quotes'] = (quote_reads, quote_torn)
+		results['positions'] = (position_reads, position_torn)
+
+	threads = [Thread(target=write), Thread(target=read)]
+	for thread in threads:
+		thread.start()
+	time.sleep(duration)
+	stop[0] = True
+	for thread in threads:
+		thread.join()
+	ib.connected = False
+
+	for name, (reads, torn) in results.items():
+		print('%-10s %8d reads (%.0f/s), %6d torn (%.1f%%)' % (name, reads, reads/duration, torn, 100.0*torn/max(1, reads)))
+	return results
+
+if __name__ == '__main__':
+	stress_test()
@@ -0,0 +1,188 @@
+# Typed model of the stock universe read from the stock csv file
+# Columns are matched by header name, so their order in the file doesn't matter.  Every value is converted and
+# validated while the file is streamed in, and stocks can be looked up by ticker in constant time.
+
+# library for interacing with csv files
+import csv
+# python logging library for monitoring and debugging
+import logging
+
+# Number of days for each unit of the minPeriod and maxPeriod columns, e.g. 2w or 1m
+PERIOD_DAYS = {'d': 1, 'w': 7, 'm': 31}
+
+# Convert a yes/no column to a bool
+def parse_bool(value):
+	value = value.strip().lower()
+	if value in ('yes', 'y', 'true', '1'):
+		return True
+	if value in ('no', 'n', 'false', '0', ''):
+		return False
+	raise ValueError('expected yes or no, got %s' % value)
+
+# Convert a period like 2w or 1m to a number of days
+def parse_period(value):
+	value = value.strip().lower()
+	if len(value) < 2 or value[-1] not in PERIOD_DAYS:
+		raise ValueError('expected a period like 2w or 1m, got %s' % value)
+	return int(value[:-1])*PERIOD_DAYS[value[-1]]
+
+# Convert a ticker, which must not be empty
+def parse_ticker(value):
+	value = value.strip().upper()
+	if not value:
+		raise ValueError('empty ticker')
+	return value
+
+# Csv header, attribute name, and converter for every column.  Columns missing from the file are left as None,
+# except for the required ones
+COLUMNS = (
+	('ticker', 'ticker', parse_ticker),
+	('targetBuy', 'target_buy', float),
+	('targetSell', 'target_sell', float),
+	('divHack', 'div_hack', parse_bool),
+	('buyStrategy', 'buy_strategy', str.strip),
+	('sellStrategy', 'sell_strategy', str.strip),
+	('priority', 'priority', int),
+	('minPeriod', 'min_period', parse_period),
+	('maxPeriod', 'max_period', parse_period),
+	('premTarget', 'prem_target', float),
+	('weightTarget', 'weight_target', float),
+)
+REQUIRED_COLUMNS = ('ticker', 'targetBuy', 'targetSell', 'weightTarget')
+
+# Parameters for a single stock.  Slots keep thousands of these small
+class Stock:
+	__slots__ = tuple(attr for header, attr, convert in COLUMNS)
+
+	def __init__(self, **kwargs):
+		for header, attr, convert in COLUMNS:
+			setattr(self, attr, kwargs.get(attr))
+
+	# Dict of the stock parameters, for logging
+	def to_dict(self):
+		return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+	def __repr__(self):
+		return 'Stock(%s)' % ', '.join('%s=%r' % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+	def __eq__(self, other):
+		return isinstance(other, Stock) and self.to_dict() == other.to_dict()
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+# Collection of stocks in file order, with a ticker to index map for constant time lookups
+class StockUniverse:
+	def __init__(self):
+		self.stocks = []
+		self.index = {}
+		# csv header, and the ticker parsed from each raw csv row, so unchanged rows can be skipped on a reload
+		self.header = None
+		self.rows = {}
+
+	def __iter__(self):
+		return iter(self.stocks)
+
+	def __len__(self):
+		return len(self.stocks)
+
+	def __contains__(self, ticker):
+		return ticker in self.index
+
+	# Add a stock.  Tickers must be unique
+	def add(self, stock):
+		if stock.ticker in self.index:
+			raise ValueError('duplicate ticker %s' % stock.ticker)
+		self.index[stock.ticker] = len(self.stocks)
+		self.stocks.append(stock)
+
+	# Return the stock for ticker, or None if it isn't in the universe
+	def get(self, ticker):
+		i = self.index.get(ticker)
+		if i is None:
+			return None
+		return self.stocks[i]
+
+	# List of tickers in file order
+	def tickers(self):
+		return [stock.ticker for stock in self.stocks]
+
+	# Remove the stock for ticker
+	def remove(self, ticker):
+		i = self.index.pop(ticker)
+		del self.stocks[i]
+		for j in range(i, len(self.stocks)):
+			self.index[self.stocks[j].ticker] = j
+
+	# Copy the parameters of stock onto the record with the same ticker, so references to the record see the change
+	def update(self, stock):
+		current = self.get(stock.ticker)
+		for attr in Stock.__slots__:
+			setattr(current, attr, getattr(stock, attr))
+
+	# Compare with a newer universe.  Returns a list of added stocks, a list of removed tickers,
+	# and a list of stocks whose parameters changed
+	def diff(self, other):
+		added = [stock for stock in other if stock.ticker not in self]
+		removed = [stock.ticker for stock in self if stock.ticker not in other]
+		changed = [stock for stock in other if stock.ticker in self and stock != self.get(stock.ticker)]
+		return added, removed, changed
+
+	# Apply the differences with a newer universe in place.  Returns the result of diff
+	def apply(self, other):
+		added, removed, changed = self.diff(other)
+		for ticker in removed:
+			self.remove(ticker)
+		for stock in changed:
+			self.update(stock)
+		for stock in added:
+			self.add(stock)
+		self.header = other.header
+		self.rows = other.rows
+		return added, removed, changed
+
+# Check the values of a parsed stock.  Raises ValueError on anything the strategy can't work with
+def validate_stock(stock):
+	if stock.target_buy <= 0 or stock.target_sell <= 0:
+		raise ValueError('targetBuy and targetSell must be positive')
+	if stock.weight_target <= 0 or stock.weight_target % 100 != 0:
+		raise ValueError('weightTarget must be a positive multiple of 100')
+	if stock.min_period is not None and stock.max_period is not None and stock.min_period > stock.max_period:
+		raise ValueError('minPeriod must not be longer than maxPeriod')
+
+# Read the stock csv file in a single streaming pass and return a StockUniverse
+# If previous is given, rows that are unchanged since it was loaded reuse its records instead of being parsed again
+# Raises ValueError with the line number if a row can't be converted or fails validation
+def load_universe(path, previous=None):
+	logging.debug('Parsing stock csv %s', path)
+	universe = StockUniverse()
+	with open(path, 'r') as csvfile:
+		stock_reader = csv.reader(csvfile)
+		header = next(stock_reader, None)
+		if header is None:
+			raise ValueError('%s is empty' % path)
+		keys = [key.strip() for key in header]
+		universe.header = keys
+		if previous is not None and previous.header != keys:
+			previous = None
+		missing = [key for key in REQUIRED_COLUMNS if key not in keys]
+		if missing:
+			raise ValueError('%s is missing columns %s' % (path, ', '.join(missing)))
+		# position of each known column in the file
+		columns = [(keys.index(header), attr, convert) for header, attr, convert in COLUMNS if header in keys]
+		for row in stock_reader:
+			# skip blank lines
+			if not row or not any(value.strip() for value in row):
+				continue
+			row_key = tuple(row)
+			try:
+				if previous is not None and row_key in previous.rows:
+					stock = previous.get(previous.rows[row_key])
+				else:
+					stock = Stock(**dict((attr, convert(row[i])) for i, attr, convert in columns))
+					validate_stock(stock)
+				universe.add(stock)
+			except (ValueError, IndexError) as e:
+				raise ValueError('%s line %d: %s' % (path, stock_reader.line_num, str(e)))
+			universe.rows[row_key] = stock.ticker
+	return universe
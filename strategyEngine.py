@@ -0,0 +1,257 @@
+# Runs several trading strategies in one process on a single shared IB interface
+# Strategies are plugins that get a data client instead of their own IbInterface.  The clients all go through one
+# MarketData layer, which merges identical quote, chain, position, and order requests made at the same time by
+# different strategies into a single request, so adding a strategy doesn't add its own load on the API.
+# Every strategy tags its orders with an order reference starting with its name, and only sees and cancels its own.
+
+# used for the age of shared results
+import time
+from threading import Lock, Event
+# python logging library for monitoring and debugging
+import logging
+
+# interface class to IB market data
+from ibInterface import IbInterface, STOCK_QUOTE_READY, OPTION_QUOTE_READY
+# running collateral and exposure totals, shared by all strategies since positions are account wide
+from exposureEngine import ExposureEngine
+# state published by the strategies for the monitor
+from snapshots import DictSnapshot
+
+# Results younger than this many seconds are handed to other callers instead of making a new request
+SHARE_TIME = .5
+# Number of shared results kept before old ones are cleared out
+MAX_RESULTS = 1000
+
+# Base class for strategy plugins
+# A strategy is constructed with a data client and its name, runs on its own thread(s) from construction, and stops
+# in shut_down.  chain_max_days and chain_strike_band tell the engine how much of each option chain the strategy needs
+class Strategy:
+	chain_max_days = None
+	chain_strike_band = None
+
+	def __init__(self, data, name):
+		self.data = data
+		self.name = name
+
+	# Stop trading.  Working orders are left in place
+	def shut_down(self):
+		pass
+
+	# Publish the strategy's state for the monitor, as a dict of sections.  The dict must not be changed afterwards
+	def publish_state(self, state):
+		self.data.monitor_state.set(self.name, state)
+
+# A request shared by every caller that asks for the same thing while it is in flight, or shortly after
+# error holds the exception the fetch raised, if any, so every caller sees the failure and not a missing value
+class SharedResult:
+	def __init__(self):
+		self.event = Event()
+		self.value = None
+		self.error = None
+		self.time = None
+
+# Shared data layer over one IbInterface
+class MarketData:
+	def __init__(self, ibif, share_time=SHARE_TIME, max_collateral=1.0):
+		self.ibif = ibif
+		self.share_time = share_time
+		self.exposure = ExposureEngine(max_collateral)
+		# shared results keyed by request, and the lock guarding the table
+		self.results = {}
+		self.lock = Lock()
+		# tickers each strategy streams quotes for, keyed by strategy name
+		self.subscribers = {}
+		# latest state published by each strategy, keyed by strategy name
+		self.monitor_state = DictSnapshot()
+
+	# Get the shared result for every key in key_list, fetching the ones nobody else has in flight or has fetched
+	# within share_time.  fetch is called with the list of missing keys and returns a dict of values keyed by key
+	# If the fetch raises, the exception is raised in every caller waiting on it.  Failed results aren't shared
+	# afterwards, so the next caller fetches again
+	def _shared(self, key_list, fetch):
+		now = time.time()
+		owned = []
+		shared = {}
+		with self.lock:
+			for key in key_list:
+				result = self.results.get(key)
+				if result is None or (result.event.is_set() and (result.error is not None or now - result.time > self.share_time)):
+					result = self.results[key] = SharedResult()
+					owned.append(key)
+				shared[key] = result
+			if owned and len(self.results) > MAX_RESULTS:
+				self._prune(now)
+		if owned:
+			values = {}
+			error = None
+			try:
+				values = fetch(owned)
+			except Exception as e:
+				error = e
+			done = time.time()
+			for key in owned:
+				shared[key].value = values.get(key)
+				shared[key].error = error
+				shared[key].time = done
+				shared[key].event.set()
+		for result in shared.values():
+			result.event.wait()
+			if result.error is not None:
+				raise result.error
+		return dict((key, result.value) for key, result in shared.items())
+
+	# Drop results too old to be shared.  Called with the lock held
+	def _prune(self, now):
+		for key in [key for key, result in self.results.items() if result.event.is_set() and now - result.time > self.share_time]:
+			del self.results[key]
+
+	def get_stock_quotes(self, ticker_list, ready=STOCK_QUOTE_READY):
+		keys = [('stock', ticker, ready) for ticker in ticker_list]
+		fetch = lambda owned: dict((('stock', ticker, ready), quote) for ticker, quote in
+								self.ibif.get_stock_quotes([key[1] for key in owned], ready).items())
+		quotes = self._shared(keys, fetch)
+		return dict((key[1], dict(quote)) for key, quote in quotes.items())
+
+	def get_stock_quote(self, ticker):
+		return self.get_stock_quotes([ticker])[ticker]
+
+	def get_option_quote(self, ticker, date, right, strike, ready=OPTION_QUOTE_READY):
+		key = ('option', ticker, date, right, strike, ready)
+		fetch = lambda owned: {key: self.ibif.get_option_quote(ticker, date, right, strike, ready)}
+		return dict(self._shared([key], fetch)[key])
+
+	# Chains are cached by the interface, so only requests for the same ticker at the same time need merging
+	def load_chains(self, ticker_list, spot_dict=None):
+		keys = [('chain', ticker) for ticker in ticker_list]
+		def fetch(owned):
+			self.ibif.load_chains([key[1] for key in owned], spot_dict)
+			return dict((key, True) for key in owned)
+		self._shared(keys, fetch)
+
+	# The chain is loaded through the coalesced load_chains, and then read from the interface's cache without loading
+	# it again
+	def get_expiries(self, ticker):
+		self.load_chains([ticker])
+		return self.ibif.get_expiries(ticker, load=False)
+
+	def get_strikes(self, ticker, expiry):
+		self.load_chains([ticker])
+		return self.ibif.get_strikes(ticker, expiry, load=False)
+
+	def get_positions(self):
+		return list(self._shared(['positions'], lambda owned: {'positions': self.ibif.get_positions()})['positions'])
+
+	def get_open_orders(self):
+		return dict(self._shared(['open_orders'], lambda owned: {'open_orders': self.ibif.get_open_orders()})['open_orders'])
+
+	def get_account_value(self):
+		return self._shared(['account'], lambda owned: {'account': self.ibif.get_account_value()})['account']
+
+	# Stream quotes for a strategy.  The interface subscription is kept while any strategy still wants the ticker
+	def subscribe_stock_quotes(self, owner, ticker_list):
+		with self.lock:
+			self.subscribers.setdefault(owner, set()).update(ticker_list)
+		self.ibif.subscribe_stock_quotes(ticker_list)
+
+	def unsubscribe_stock_quotes(self, owner, ticker_list):
+		with self.lock:
+			self.subscribers.setdefault(owner, set()).difference_update(ticker_list)
+			wanted = set()
+			for tickers in self.subscribers.values():
+				wanted.update(tickers)
+		self.ibif.unsubscribe_stock_quotes([ticker for ticker in ticker_list if ticker not in wanted])
+
+	# Data client for the named strategy
+	def client(self, owner):
+		return DataClient(self, owner)
+
+# The view of the shared data layer handed to a strategy.  Offers the IbInterface methods a strategy uses, with
+# subscriptions and orders scoped to the strategy
+class DataClient:
+	def __init__(self, market_data, owner):
+		self.market_data = market_data
+		self.owner = owner
+		# order references of this strategy start with its name
+		self.ref_prefix = owner + '.'
+
+	# Anything not scoped to the strategy goes straight to the shared layer, or the interface behind it
+	def __getattr__(self, name):
+		if hasattr(self.market_data, name):
+			return getattr(self.market_data, name)
+		return getattr(self.market_data.ibif, name)
+
+	# Check if an order reference belongs to this strategy
+	def owns(self, order_ref):
+		return order_ref is not None and order_ref.startswith(self.ref_prefix)
+
+	def subscribe_stock_quotes(self, ticker_list):
+		self.market_data.subscribe_stock_quotes(self.owner, ticker_list)
+
+	def unsubscribe_stock_quotes(self, ticker_list):
+		self.market_data.unsubscribe_stock_quotes(self.owner, ticker_list)
+
+	# Open orders of this strategy only, keyed by id
+	def get_open_orders(self):
+		return dict((order_id, order) for order_id, order in self.market_data.get_open_orders().items() if self.owns(order.get('order_ref')))
+
+	def get_open_order_ids(self):
+		return list(self.get_open_orders().keys())
+
+	# Fills of this strategy's orders only, from the interface's fill ledger
+	def get_fills(self, order_id=None, ticker=None, day=None):
+		return [fill for fill in self.market_data.ibif.get_fills(order_id, ticker, day) if self.owns(fill.get('order_ref'))]
+
+	# Cancel the working orders of this strategy only
+	def cancel_all_orders(self):
+		return self.market_data.ibif.cancel_orders(self.get_open_order_ids())
+
+	# Release the strategy's quote streams.  The interface itself is shut down by the engine
+	def shut_down(self):
+		with self.market_data.lock:
+			tickers = list(self.market_data.subscribers.get(self.owner, ()))
+		self.unsubscribe_stock_quotes(tickers)
+
+# Owns the IB interface and the shared data layer, and runs the strategies on them
+class StrategyEngine:
+	def __init__(self, client_id=0, num_clients=1, max_collateral=1.0):
+		self.ibif = IbInterface(client_id=client_id, num_clients=num_clients)
+		self.data = MarketData(self.ibif, max_collateral=max_collateral)
+		self.strategies = []
+		# catch up on the day's fills once for all strategies, before any of them looks at its orders
+		self.ibif.load_executions()
+
+	# Start a strategy of class strategy_class under the given name.  Names must be unique, since they tag the orders
+	# extra keyword arguments are passed on to the strategy
+	def add_strategy(self, strategy_class, name, **kwargs):
+		if any(strategy.name == name for strategy in self.strategies):
+			raise ValueError('duplicate strategy name %s' % name)
+		if '.' in name:
+			raise ValueError('strategy name %s must not contain a dot' % name)
+		self._fit_chains(strategy_class)
+		logging.info('Starting strategy %s (%s)', name, strategy_class.__name__, extra={'strategy': name})
+		strategy = strategy_class(self.data.client(name), name, **kwargs)
+		self.strategies.append(strategy)
+		return strategy
+
+	# Widen the chain window and strike band of the interface to cover what the strategy needs
+	def _fit_chains(self, strategy_class):
+		if not self.strategies:
+			self.ibif.chain_max_days = strategy_class.chain_max_days
+			self.ibif.chain_strike_band = strategy_class.chain_strike_band
+			return
+		if self.ibif.chain_max_days is not None:
+			if strategy_class.chain_max_days is None:
+				self.ibif.chain_max_days = None
+			else:
+				self.ibif.chain_max_days = max(self.ibif.chain_max_days, strategy_class.chain_max_days)
+		if self.ibif.chain_strike_band is not None:
+			if strategy_class.chain_strike_band is None:
+				self.ibif.chain_strike_band = None
+			else:
+				self.ibif.chain_strike_band = max(self.ibif.chain_strike_band, strategy_class.chain_strike_band)
+
+	# Stop every strategy, then the interface
+	def shut_down(self):
+		for strategy in self.strategies:
+			strategy.shut_down()
+		self.ibif.shut_down()